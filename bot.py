@@ -1,9 +1,14 @@
+import asyncio
 import datetime
+import itertools
 import json
 import logging
 import sys
+import time
 import traceback
-from collections import Counter, deque, defaultdict
+import weakref
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque, defaultdict
 from typing import Optional
 
 import aiohttp
@@ -12,8 +17,19 @@ from qq.ext import commands
 
 import config
 from cogs import context
+from cogs.utils import image_upload
 from cogs.utils.config import Config
 
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 description = """
 你好! 我是一个由狐白写的机器人。
 """
@@ -28,14 +44,18 @@ initial_extensions = (
 )
 
 
+def _pretty_event(data):
+    if orjson is not None:
+        return orjson.dumps(orjson.loads(data), option=orjson.OPT_INDENT_2).decode('utf-8')
+    return json.dumps(json.loads(data), ensure_ascii=True, indent=4)
+
+
 def _prefix_callable(bot, msg):
-    user_id = bot.user.id
-    base = [f'<@!{user_id}> ', f'<@{user_id}> ']
-    if msg.guild is None:
-        base.append('/')
-    else:
-        base.extend(bot.prefixes.get(msg.guild.id, ['/']))
-    return base
+    guild_id = None if msg.guild is None else msg.guild.id
+    try:
+        return bot._prefix_cache[guild_id]
+    except KeyError:
+        return bot._prefix_cache.setdefault(guild_id, bot._build_prefixes(guild_id))
 
 
 class BeepBoopFox(commands.AutoShardedBot):
@@ -62,7 +82,23 @@ class BeepBoopFox(commands.AutoShardedBot):
 
         self.bots_app_id = config.bots_app_id
         self.bots_token = config.bots_token
-        self.session = aiohttp.ClientSession(loop=self.loop)
+        # aiohttp's default connector only keeps sockets alive for 15s and
+        # resolves DNS on the default executor, so bursts of outgoing requests
+        # end up redoing the TCP and TLS handshakes every time.
+        connector = aiohttp.TCPConnector(
+            limit=200,
+            limit_per_host=32,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            resolver=aiohttp.AsyncResolver(loop=self.loop) if aiodns is not None else None,
+            loop=self.loop,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30),
+            loop=self.loop,
+        )
 
         self._prev_events = deque(maxlen=10)
 
@@ -73,13 +109,26 @@ class BeepBoopFox(commands.AutoShardedBot):
 
         # guild_id: list
         self.prefixes = Config('prefixes.json')
+
+        # guild_id (None for DMs): tuple of every prefix, mentions included
+        self._prefix_cache = {}
+        # filled in once our user ID is known, see on_ready
+        self._mention_prefixes = ()
+
         self.pixel = Config('pixels.json')
 
+        # (guild_id, member_id): time.monotonic() deadline, oldest first
+        # members that recently failed to fetch, so we don't keep asking for them
+        self._member_misses = OrderedDict()
+
         # guild_id and user_id mapped to True
         # these are users and guilds globally blacklisted
         # from using the bot
         self.blacklist = Config('blacklist.json')
 
+        # an in-memory mirror of the blacklist keys for the per-message checks
+        self._blacklist_ids = {int(k) for k in self.blacklist.all()}
+
         self.bilibili = Config('bilibili.json')
 
         # in case of even further spam, add a cooldown mapping
@@ -89,6 +138,9 @@ class BeepBoopFox(commands.AutoShardedBot):
         # A counter to auto-ban frequent spammers
         # Triggering the rate limit 5 times in a row will auto-ban the user from the bot.
         self._auto_spam_count = Counter()
+        # user_id: asyncio.Lock, so the auto-ban decision is made once per user
+        # the locks are dropped as soon as nobody is holding on to them
+        self._spam_locks = weakref.WeakValueDictionary()
         for extension in initial_extensions:
             try:
                 self.load_extension(extension)
@@ -98,17 +150,16 @@ class BeepBoopFox(commands.AutoShardedBot):
 
     def _clear_gateway_data(self):
         one_week_ago = qq.utils.utcnow() - datetime.timedelta(days=7)
-        for shard_id, dates in self.identifies.items():
-            to_remove = [index for index, dt in enumerate(dates) if dt < one_week_ago]
-            for index in reversed(to_remove):
-                del dates[index]
-
-        for shard_id, dates in self.resumes.items():
-            to_remove = [index for index, dt in enumerate(dates) if dt < one_week_ago]
-            for index in reversed(to_remove):
-                del dates[index]
+        # the dates are appended as they happen so every list is already sorted
+        for dates in itertools.chain(self.identifies.values(), self.resumes.values()):
+            index = bisect_left(dates, one_week_ago)
+            if index:
+                del dates[:index]
 
     async def on_socket_raw_receive(self, msg):
+        # qq.py has already decompressed and decoded the payload into a str by
+        # the time it gets here, so keep a reference to it as-is rather than
+        # paying for another copy by encoding it back to bytes
         self._prev_events.append(msg)
 
     async def before_identify_hook(self, shard_id: Optional[int], *, initial: bool = False) -> None:
@@ -124,9 +175,7 @@ class BeepBoopFox(commands.AutoShardedBot):
         elif isinstance(error, commands.CommandInvokeError):
             original = error.original
             if not isinstance(original, qq.HTTPException):
-                print(f'In {ctx.command.qualified_name}:', file=sys.stderr)
-                traceback.print_tb(original.__traceback__)
-                print(f'{original.__class__.__name__}: {original}', file=sys.stderr)
+                logger.error('In %s:', ctx.command.qualified_name, exc_info=original)
         elif isinstance(error, commands.ArgumentParsingError):
             await ctx.reply(str(error))
 
@@ -135,25 +184,35 @@ class BeepBoopFox(commands.AutoShardedBot):
         proxy_msg.guild = guild
         return local_inject(self, proxy_msg)
 
+    def _build_prefixes(self, guild_id):
+        if guild_id is None:
+            return (*self._mention_prefixes, '/')
+        return (*self._mention_prefixes, *self.prefixes.get(guild_id, ['/']))
+
     def get_raw_guild_prefixes(self, guild_id):
         return self.prefixes.get(guild_id, ['/'])
 
     async def set_guild_prefixes(self, guild, prefixes):
-        if len(prefixes) == 0:
-            await self.prefixes.put(guild.id, [])
-        elif len(prefixes) > 10:
+        if len(prefixes) > 10:
             raise RuntimeError('自定义前缀不能超过 10 个。')
-        else:
-            await self.prefixes.put(guild.id, sorted(set(prefixes), reverse=True))
+
+        prefixes = sorted(set(prefixes), reverse=True)
+        if self.prefixes.get(guild.id, ['/']) == prefixes:
+            return
+
+        await self.prefixes.put(guild.id, prefixes)
+        self._prefix_cache.pop(guild.id, None)
 
     async def add_to_blacklist(self, object_id):
         await self.blacklist.put(object_id, True)
+        self._blacklist_ids.add(object_id)
 
     async def remove_from_blacklist(self, object_id):
         try:
             await self.blacklist.remove(object_id)
         except KeyError:
             pass
+        self._blacklist_ids.discard(object_id)
 
     async def query_member_named(self, guild: qq.Guild, argument: str):
         """Queries a member by their name, or nickname.
@@ -170,6 +229,10 @@ class BeepBoopFox(commands.AutoShardedBot):
         Optional[Member]
             The member matching the query or None if not found.
         """
+        for member in guild.members:
+            if member.nick == argument or member.name == argument:
+                return member
+
         async for member in guild.fetch_members(limit=1000):
             if member.nick == argument or member.name == argument:
                 return member
@@ -194,10 +257,25 @@ class BeepBoopFox(commands.AutoShardedBot):
         if member is not None:
             return member
 
-        shard = self.get_shard(guild.shard_id)
+        key = (guild.id, member_id)
+        now = time.monotonic()
+        expires = self._member_misses.get(key)
+        if expires is not None:
+            if expires > now:
+                return None
+            del self._member_misses[key]
+
         try:
             member = await guild.fetch_member(member_id)
         except qq.HTTPException:
+            misses = self._member_misses
+            # every entry gets the same lifetime, so the expired ones are all at the front
+            while misses and next(iter(misses.values())) <= now:
+                misses.popitem(last=False)
+            if len(misses) >= 1000:
+                misses.popitem(last=False)
+            misses[key] = now + 60.0
+            misses.move_to_end(key)
             return None
         else:
             return member
@@ -232,68 +310,99 @@ class BeepBoopFox(commands.AutoShardedBot):
             else:
                 needs_resolution.append(member_id)
 
-        for resolver in needs_resolution:
-            try:
-                member = await guild.fetch_member(resolver)
-            except qq.HTTPException:
-                pass
-            else:
+        # the QQ API has no bulk member lookup so the best we can do is to
+        # fire off the individual requests concurrently, a chunk at a time
+        for chunk in qq.utils.as_chunks(needs_resolution, 100):
+            results = await asyncio.gather(*map(guild.fetch_member, chunk), return_exceptions=True)
+            for member in results:
+                if isinstance(member, qq.HTTPException):
+                    continue
+                if isinstance(member, BaseException):
+                    raise member
                 yield member
 
     async def on_ready(self):
         if not hasattr(self, 'uptime'):
             self.uptime = qq.utils.utcnow()
 
+        user_id = self.user.id
+        self._mention_prefixes = (f'<@!{user_id}> ', f'<@{user_id}> ')
+        self._prefix_cache.clear()
+
         logger.info(f'Ready: {self.user} (ID: {self.user.id})')
 
     async def on_shard_resumed(self, shard_id):
         logger.info(f'Shard ID {shard_id} has resumed...')
         self.resumes[shard_id].append(qq.utils.utcnow())
 
-    def log_spammer(self, ctx, message, retry_after, *, auto_block=False):
-        guild_name = getattr(ctx.guild, 'name', 'No Guild (DMs)')
-        guild_id = getattr(ctx.guild, 'id', None)
+    def log_spammer(self, message, retry_after, *, auto_block=False):
+        guild = message.guild
+        author = message.author
+        if guild is None:
+            guild_name, guild_id = 'No Guild (DMs)', None
+        else:
+            guild_name, guild_id = guild.name, guild.id
+
         fmt = '频道 %r (ID %s) 中的用户 %s (ID %s) 刷屏，retry_after: %.2fs'
-        logger.warning(fmt, guild_name, guild_id, message.author, message.author.id, retry_after)
+        logger.warning(fmt, guild_name, guild_id, author, author.id, retry_after)
         if not auto_block:
             return
 
+        channel = message.channel
         embed = qq.Embed(title='自动封禁成员', colour=0xDDA453)
-        embed.add_field(name=f'成员: {message.author} (ID: {message.author.id})', inline=False)
+        embed.add_field(name=f'成员: {author} (ID: {author.id})', inline=False)
         embed.add_field(name=f'频道资讯: {guild_name} (ID: {guild_id})', inline=False)
-        embed.add_field(name=f'子频道资讯: {message.channel} (ID: {message.channel.id})', inline=False)
+        embed.add_field(name=f'子频道资讯: {channel} (ID: {channel.id})', inline=False)
         embed.timestamp = qq.utils.utcnow()
-        embed.set_thumbnail(url=message.author.avatar.url)
-        return self.get_channel(1697291).send(embed=embed, msg_id=ctx.message)
-
-    async def process_commands(self, message):
-        ctx = await self.get_context(message, cls=context.Context)
+        embed.set_thumbnail(url=author.avatar.url)
+        return self.get_channel(1697291).send(embed=embed, msg_id=message)
 
-        if ctx.command is None:
-            return
+    async def _auto_ban(self, message, retry_after):
+        author_id = message.author.id
+        self._blacklist_ids.add(author_id)
+        del self._auto_spam_count[author_id]
+        # this only schedules the write to disk
+        await self.blacklist.put(author_id, True)
+        # no need to hold up the message handling for the report
+        self.loop.create_task(self.log_spammer(message, retry_after, auto_block=True))
 
-        if ctx.author.id in self.blacklist:
+    async def process_commands(self, message):
+        # the blacklist and the spam check only need the message, so run them
+        # before paying for the context and the command lookup
+        author_id = message.author.id
+        if author_id in self._blacklist_ids:
             return
 
-        if ctx.guild is not None and ctx.guild.id in self.blacklist:
+        if message.guild is not None and message.guild.id in self._blacklist_ids:
             return
 
         bucket = self.spam_control.get_bucket(message)
         current = message.created_at.timestamp()
         retry_after = bucket.update_rate_limit(current)
-        author_id = message.author.id
         if retry_after and author_id != self.owner_id:
-            self._auto_spam_count[author_id] += 1
-            if self._auto_spam_count[author_id] >= 5:
-                await self.add_to_blacklist(author_id)
-                del self._auto_spam_count[author_id]
-                await self.log_spammer(ctx, message, retry_after, auto_block=True)
-            else:
-                self.log_spammer(ctx, message, retry_after)
+            lock = self._spam_locks.get(author_id)
+            if lock is None:
+                lock = self._spam_locks[author_id] = asyncio.Lock()
+
+            async with lock:
+                # they might have been banned while we were waiting
+                if author_id in self._blacklist_ids:
+                    return
+
+                self._auto_spam_count[author_id] += 1
+                if self._auto_spam_count[author_id] >= 5:
+                    await self._auto_ban(message, retry_after)
+                else:
+                    self.log_spammer(message, retry_after)
             return
         else:
             self._auto_spam_count.pop(author_id, None)
 
+        ctx = await self.get_context(message, cls=context.Context)
+
+        if ctx.command is None:
+            return
+
         try:
             await self.invoke(ctx)
         finally:
@@ -305,15 +414,23 @@ class BeepBoopFox(commands.AutoShardedBot):
         if message.author.bot:
             return
         message.content = message.content.replace(self.user.mention, '').strip()
+        # don't bother building a context for messages that can't be commands
+        if not message.content.startswith(_prefix_callable(self, message)):
+            return
         await self.process_commands(message)
 
     async def on_guild_join(self, guild):
-        if guild.id in self.blacklist:
+        if guild.id in self._blacklist_ids:
             await guild.leave()
 
     async def close(self):
         await super().close()
+        for config in (self.prefixes, self.pixel, self.blacklist, self.bilibili):
+            await config.flush()
         await self.session.close()
+        await image_upload.close()
+        # give the underlying SSL transports a moment to shut down
+        await asyncio.sleep(0.25)
 
     def run(self):
         try:
@@ -322,7 +439,7 @@ class BeepBoopFox(commands.AutoShardedBot):
             with open('prev_events.log', 'w', encoding='utf-8') as fp:
                 for data in self._prev_events:
                     try:
-                        x = json.dumps(json.loads(data), ensure_ascii=True, indent=4)
+                        x = _pretty_event(data)
                     except:
                         fp.write(f'{data}\n')
                     else:
@@ -1,15 +1,17 @@
+import ast
 import asyncio
 import copy
 import importlib
 import inspect
 import io
-import os
 import re
+import shlex
 import subprocess
 import sys
 import textwrap
 import time
 import traceback
+import types
 from contextlib import redirect_stdout
 from typing import Union, Optional
 
@@ -93,12 +95,18 @@ class Admin(commands.Cog):
     def display_emoji(self) -> qq.PartialEmoji:
         return qq.PartialEmoji(name='stafftools', id=314348604095594498)
 
-    async def run_process(self, command):
+    async def run_process(self, command, *, shell=True):
+        # commands that don't need the shell are run directly, which
+        # saves spawning a /bin/sh just to parse them
+        args = command if shell else shlex.split(command)
         try:
-            process = await asyncio.create_subprocess_shell(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if shell:
+                process = await asyncio.create_subprocess_shell(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            else:
+                process = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             result = await process.communicate()
         except NotImplementedError:
-            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            process = subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             result = await self.bot.loop.run_in_executor(None, process.communicate)
 
         return [output.decode() for output in result]
@@ -115,6 +123,23 @@ class Admin(commands.Cog):
     async def cog_check(self, ctx):
         return await self.bot.is_owner(ctx.author)
 
+    def compile_eval(self, body, env):
+        """Compiles code for eval into a callable, allowing top-level await.
+
+        Bodies that use ``return`` can't be compiled as-is, so those still go
+        through an ``async def`` wrapper.
+        """
+        flags = ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+        for mode in ('eval', 'exec'):
+            try:
+                code = compile(body, '<eval>', mode, flags=flags)
+            except SyntaxError:
+                continue
+            return types.FunctionType(code, env)
+
+        exec(f'async def func():\n{textwrap.indent(body, "  ")}', env)
+        return env['func']
+
     def get_syntax_error(self, e):
         if e.text is None:
             return f'```py\n{e.__class__.__name__}: {e}\n```'
@@ -150,24 +175,21 @@ class Admin(commands.Cog):
         else:
             await ctx.reply('\N{OK HAND SIGN}')
 
-    _GIT_PULL_REGEX = re.compile(r'\s*(?P<filename>.+?)\s*\|\s*[0-9]+\s*[+-]+')
+    _GIT_PULL_REGEX = re.compile(r'\s*(?P<filename>.+?)\s*\|\s*[0-9]+\s*[+-]+', re.ASCII)
 
     def find_modules_from_git(self, output):
-        files = self._GIT_PULL_REGEX.findall(output)
-        ret = []
-        for file in files:
-            root, ext = os.path.splitext(file)
-            if ext != '.py':
-                continue
-
-            if root.startswith('cogs/'):
-                # A submodule is a directory inside the main cog directory for
-                # my purposes
-                ret.append((root.count('/') - 1, root.replace('/', '.')))
+        # the same file can show up more than once, e.g. in a rename, and
+        # each module should only be reloaded once
+        roots = {
+            filename[:-3]
+            for filename in self._GIT_PULL_REGEX.findall(output)
+            if filename.endswith('.py') and filename.startswith('cogs/')
+        }
 
+        # A submodule is a directory inside the main cog directory for
+        # my purposes
         # For reload order, the submodules should be reloaded first
-        ret.sort(reverse=True)
-        return ret
+        return sorted(((root.count('/') - 1, root.replace('/', '.')) for root in roots), reverse=True)
 
     def reload_or_load_extension(self, module):
         try:
@@ -179,7 +201,7 @@ class Admin(commands.Cog):
     async def _reload_all(self, ctx):
         """重新加载所有模块，同时从 git 中 pull。"""
 
-        stdout, stderr = await self.run_process('git pull')
+        stdout, stderr = await self.run_process('git pull', shell=False)
 
         # progress and stuff is redirected to stderr in git pull
         # however, things like "fast forward" and files
@@ -236,17 +258,16 @@ class Admin(commands.Cog):
         body = self.cleanup_code(body)
         stdout = io.StringIO()
 
-        to_compile = f'async def func():\n{textwrap.indent(body, "  ")}'
-
         try:
-            exec(to_compile, env)
+            func = self.compile_eval(body, env)
         except Exception as e:
             return await ctx.reply(f'```py\n{e.__class__.__name__}: {e}\n```')
 
-        func = env['func']
         try:
             with redirect_stdout(stdout):
-                ret = await func()
+                ret = func()
+                if inspect.isawaitable(ret):
+                    ret = await ret
         except Exception as e:
             value = stdout.getvalue()
             await ctx.reply(f'```py\n{value}{traceback.format_exc()}\n```')
@@ -307,7 +328,7 @@ class Admin(commands.Cog):
             if cleaned.count('\n') == 0:
                 # single statement, potentially 'eval'
                 try:
-                    code = compile(cleaned, '<repl session>', 'eval')
+                    code = compile(cleaned, '<repl session>', 'eval', flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
                 except SyntaxError:
                     pass
                 else:
@@ -315,7 +336,7 @@ class Admin(commands.Cog):
 
             if executor is exec:
                 try:
-                    code = compile(cleaned, '<repl session>', 'exec')
+                    code = compile(cleaned, '<repl session>', 'exec', flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
                 except SyntaxError as e:
                     await ctx.reply(self.get_syntax_error(e))
                     continue
@@ -327,7 +348,9 @@ class Admin(commands.Cog):
 
             try:
                 with redirect_stdout(stdout):
-                    result = executor(code, variables)
+                    # eval also runs 'exec' code, and unlike exec it hands back the
+                    # coroutine that top-level await produces so it can be awaited
+                    result = eval(code, variables)
                     if inspect.isawaitable(result):
                         result = await result
             except Exception as e:
@@ -1,5 +1,4 @@
 import asyncio
-import base64
 import json
 import logging
 import random
@@ -7,67 +6,90 @@ import time
 import traceback
 from io import BytesIO
 
+import cv2
+import numpy
 import qq
 from PIL import Image
 from qq import TextChannel
 from qq.ext import commands, tasks
 
+from cogs.utils.image_upload import upload
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
 
+# the dynamic feed nests JSON strings inside JSON, so this gets called a lot
+_loads = orjson.loads if orjson is not None else json.loads
+
+# sent with every bilibili request, the per user Referer gets merged on top
+HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36',
+}
+
 
 class Bilibili(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.config = bot.bilibili
         self.messageLengthLimit = self.config.get('messageLengthLimit', 0)
-        self.push_uid = self.config.get('push_uid', {})
-        self.push_times = self.config.get('push_times', {})
-        self.room_states = self.config.get('room_states', {})
-        self.all_user_name = self.config.get('all_user_name', {})
+        # JSON turns the uid keys into strings, everything else uses ints
+        self.push_uid = self._int_keys('push_uid')
+        self.push_times = self._int_keys('push_times')
+        self.room_states = self._int_keys('room_states')
+        self.all_user_name = self._int_keys('all_user_name')
+        self._cookie = f'LIVE_BUVID=AUTO{"".join(random.choices("0123456789", k=16))};'
         self.check_bili_dynamic_loop.start()
         self._check_lock = asyncio.Lock(loop=bot.loop)
+        # set whenever something worth persisting changed since the last save
+        self._dirty = False
+
+    def _int_keys(self, key):
+        return {int(uid): value for uid, value in self.config.get(key, {}).items()}
 
     async def save_config(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        # puts only schedule a write, the file itself is dumped in the executor
         await self.config.put('messageLengthLimit', self.messageLengthLimit)
         await self.config.put('push_uid', self.push_uid)
         await self.config.put('push_times', self.push_times)
         await self.config.put('room_states', self.room_states)
         await self.config.put('all_user_name', self.all_user_name)
-        await self.config.save()
 
     @property
     def bilibili_cookie(self):
-        return f'LIVE_BUVID=AUTO{"".join([str(random.randint(0, 9)) for _ in range(16)])};'
+        return self._cookie
 
-    async def check_uid_exsist(self, uid):
+    async def _fetch_acc_info(self, uid):
         headers = {
-            'Referer': 'https://space.bilibili.com/{user_uid}/'.format(user_uid=uid)
+            **HEADERS,
+            'Referer': 'https://space.bilibili.com/{user_uid}/'.format(user_uid=uid),
+            'Cookie': self.bilibili_cookie
         }
-
         async with self.bot.session.get(
                 'https://api.bilibili.com/x/space/acc/info',
                 params={'mid': uid}, headers=headers
         ) as resp:
-            res = await resp.json()
-            if res['code'] == 0:
-                return True
-            return False
+            return await resp.json(loads=_loads)
 
-    async def get_user_name(self, uid):
-        headers = {
-            'Referer': 'https://space.bilibili.com/{user_uid}/'.format(user_uid=uid)
-        }
-        async with self.bot.session.get(
-                'https://api.bilibili.com/x/space/acc/info',
-                params={'mid': uid}, headers=headers
-        ) as resp:
-            res = await resp.json()
-            return res['data']['name']
+    async def check_uid_exsist(self, uid):
+        res = await self._fetch_acc_info(uid)
+        if res['code'] == 0:
+            # we already have the name, so save the extra request later
+            self.all_user_name[uid] = res['data']['name']
+            return True
+        return False
 
-    async def load_all_username(self):
-        uids = self.push_uid.keys()
-        for uid in uids:
-            self.all_user_name[uid] = await self.get_user_name(uid)
+    async def get_user_name(self, uid):
+        res = await self._fetch_acc_info(uid)
+        return res['data']['name']
 
     async def load_username(self, uid):
         if uid not in self.all_user_name:
@@ -82,207 +104,258 @@ class Bilibili(commands.Cog):
         else:
             return msg
 
+    async def _send_to_channel(self, channel_id, msg, url):
+        channel: TextChannel = self.bot.get_channel(int(channel_id))
+        if not url:
+            return await channel.send(msg)
+        try:
+            # url is shared between every channel, so it must not be consumed
+            for n in url:
+                await channel.send(msg, image=n)
+        except qq.error.Forbidden:
+            await channel.send(msg)
+
     async def broadcast(self, uid, msg, url):
-        for channel_id in self.push_uid[uid]:
-            channel_id = int(channel_id)
-            channel: TextChannel = self.bot.get_channel(channel_id)
-            log.info(msg)
-            if not url:
-                await self.bot.get_channel(channel_id).send(msg)
-            else:
-                try:
-                    await channel.send(msg, image=url.pop(0))
-                    for n in url:
-                        await self.bot.get_channel(channel_id).send(msg, image=n)
-                except qq.error.Forbidden:
-                    await self.bot.get_channel(channel_id).send(msg)
+        log.info(msg)
+        # each channel keeps its own ordering, but channels don't wait on each other
+        # the uid could have been unsubscribed while we were polling it
+        channel_ids = self.push_uid.get(uid, ())
+        results = await asyncio.gather(
+            *(self._send_to_channel(channel_id, msg, url) for channel_id in channel_ids),
+            return_exceptions=True
+        )
+        for channel_id, result in zip(channel_ids, results):
+            if isinstance(result, Exception):
+                log.warning(f'推送到频道 {channel_id} 失败 uid={uid}', exc_info=result)
+
+    async def _fetch_image(self, url):
+        async with self.bot.session.get(url, headers=HEADERS) as image_resp:
+            return Image.open(BytesIO(await image_resp.read()))
 
     async def make_big_image(self, image_urls, size, image_num):
-        images = []
-        for url in image_urls:  # 下载全部图片
-            async with self.bot.session.get(url) as image_resp:
-                image = await image_resp.content
-            images.append(image)
         if image_num == 9:
-            new_img = Image.new('RGB', (size[0] * 3, size[1] * 3), 255)
-            for y in range(3):
-                for x in range(3):
-                    img = Image.open(images[y * 3 + x])
-                    new_img.paste(img, (x * size[0], y * size[1]))
+            rows = 3
         elif image_num == 6:
-            new_img = Image.new('RGB', (size[0] * 3, size[1] * 2), 255)
-            for y in range(2):
-                for x in range(3):
-                    img = Image.open(images[y * 3 + x])
-                    new_img.paste(img, (x * size[0], y * size[1]))
+            rows = 2
         else:
             return
-        output = BytesIO()
-        new_img.save(output, format='JPEG')
-        im_data = output.getvalue()
-        image_data = base64.b64encode(im_data)
-        if not isinstance(image_data, str):
-            # Python 3, decode from bytes to string
-            image_data = image_data.decode()
 
-    async def _check_bili_dynamic(self):
-        log.debug('B站动态检查开始')
-        for uid in self.push_uid.keys():
-            headers = {
-                'Referer': 'https://space.bilibili.com/{user_uid}/'.format(user_uid=uid)
-            }
+        images = await asyncio.gather(*map(self._fetch_image, image_urls))  # 下载全部图片
+        tiles = []
+        for image in images:
+            with image:
+                rgb = image.convert('RGB')
+                if rgb.size != tuple(size):
+                    rgb = rgb.resize(tuple(size))
+                tiles.append(numpy.asarray(rgb))
+
+        # every tile has the same size so the grid can be stitched together
+        # with plain array concatenation
+        big_image = numpy.concatenate([numpy.concatenate(tiles[y * 3:y * 3 + 3], axis=1) for y in range(rows)])
+        # OpenCV expects BGR
+        _, buffer = cv2.imencode('.jpg', big_image[:, :, ::-1], [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        # messages can only carry images by url, so host the raw jpeg somewhere
+        return await upload(BytesIO(buffer.tobytes()))
+
+    async def _big_image_urls(self, image_urls, size, image_num):
+        # push_times has already moved past this card, so a failed render or
+        # upload must not lose it, send the pictures one by one instead
+        try:
+            return [await self.make_big_image(image_urls, size, image_num)]
+        except Exception:
+            log.warning('拼接图片失败，改为逐张发送\n' + traceback.format_exc())
+            return image_urls
+
+    async def _handle_pictures(self, card, content):  # 带图片动态
+        msg = '动态：\n'
+        url = []
+        pictures_count = content['item']['pictures_count']
+        true_content = content['item']['description']
+        true_content = self.get_limited_message(true_content)
+        msg += true_content
+        pictures = content['item']['pictures']
+        if pictures_count > 0:
+            is_big_picture = False
+            first_picture_size = [pictures[0]['img_width'], pictures[0]['img_height']]
+            if pictures_count >= 9:
+                is_big_picture = True
+                for i in range(9):
+                    if pictures[i]['img_width'] != first_picture_size[0] or pictures[i]['img_height'] != \
+                            first_picture_size[1]:
+                        is_big_picture = False
+                if is_big_picture:
+                    picture_srcs = []
+                    for i in range(9):
+                        picture_srcs.append(pictures[i]['img_src'])
+                    url = await self._big_image_urls(picture_srcs, first_picture_size, 9)
+            if pictures_count >= 6 and not is_big_picture:
+                is_big_picture = True
+                for i in range(6):
+                    if pictures[i]['img_width'] != first_picture_size[0] or pictures[i]['img_height'] != \
+                            first_picture_size[1]:
+                        is_big_picture = False
+                if is_big_picture:
+                    picture_srcs = []
+                    for i in range(6):
+                        picture_srcs.append(pictures[i]['img_src'])
+                    url = await self._big_image_urls(picture_srcs, first_picture_size, 6)
+            if not is_big_picture:
+                if pictures_count > 0 and pictures_count < 4:
+                    url = []
+                    for pic in pictures:
+                        url.append(pic['img_src'])
+        return msg, url
+
+    async def _handle_text(self, card, content):  # 纯文字动态
+        msg = '动态：\n'
+        true_content = content['item']['content']
+        true_content = self.get_limited_message(true_content)
+        msg += true_content
+        return msg, []
+
+    async def _handle_article(self, card, content):  # 文章
+        msg = '文章：\n'
+        cv_id = str(content['id'])
+        title = content['title']
+        summary = content['summary']
+        url = [content['image_urls'][0]]
+        msg += title + '\n' + summary + '……' + f'\nhttps://www.bilibili.com/read/cv{cv_id}'
+        return msg, url
+
+    async def _handle_video(self, card, content):  # 投稿视频
+        msg = '视频：\n'
+        bv_id = card['desc']['bvid']
+        url = [content['pic']]
+        msg += content['title'] + '\n' + self.get_limited_message(content['desc']) + '\n' + \
+               f'\nhttps://www.bilibili.com/video/{bv_id}'
+        return msg, url
+
+    async def _handle_repost(self, card, content):  # 转发动态
+        msg = '转发动态：\n'
+        msg += content['item']['content'] + '\n'
+        origin_type = content['item']['orig_type']
+        origin_content = _loads(content['origin'])
+        if origin_type == 2:
+            origin_user = origin_content['user']['name']
+            msg += '>>' + origin_user + ': /n'
+            origin_true_content = origin_content['item']['description']
+            origin_true_content = self.get_limited_message(origin_true_content)
+            msg += origin_true_content
+        elif origin_type == 4:
+            origin_user = origin_content['user']['name']
+            msg += '>>' + origin_user + ': /n'
+            origin_true_content = origin_content['item']['content']
+            origin_true_content = self.get_limited_message(origin_true_content)
+            msg += origin_true_content
+        elif origin_type == 8:
+            bv_id = card['desc']['origin']['bvid']
+            title = origin_content['title']
+            owner_name = origin_content['owner']['name']
+            msg += '>>' + owner_name + '的视频:' + title + '\n' + '>>bv' + bv_id
+        elif origin_type == 64:
+            title = origin_content['title']
+            cv_id = str(origin_content['id'])
+            owner_name = origin_content['author']['name']
+            msg += '>>' + owner_name + '的文章:' + title + '\n' + '>>cv' + cv_id
+        else:
+            msg += '>>暂不支持的源动态类型，请进入动态查看'
+        return msg, []
+
+    async def _handle_unknown(self, card, content):
+        return '动态：\n暂不支持该动态类型，请进入原动态查看', []
+
+    # dynamic type -> handler returning (message body, image urls)
+    _DYNAMIC_HANDLERS = {
+        1: _handle_repost,
+        2: _handle_pictures,
+        4: _handle_text,
+        8: _handle_video,
+        64: _handle_article,
+    }
+    # these already end with a link to the video/article itself
+    _SELF_LINKED_TYPES = frozenset((8, 64))
+
+    async def _poll_dynamic(self, uid, sem):
+        headers = {
+            **HEADERS,
+            'Referer': 'https://space.bilibili.com/{user_uid}/'.format(user_uid=uid)
+        }
+        async with sem:
             async with self.bot.session.get(
                     'https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/space_history?host_uid={user_uid}',
                     params={'host_uid': uid},
                     headers=headers
             ) as resp:
-                res = await resp.json()
-                if res is None:
-                    log.warning(f'检查{uid}时出错 request response is None')
-                    continue
-                cards = res['data']['cards']
-            # cards=[res['data']['cards'][10]]
-            uid_time = self.push_times.get(uid, 0)
-            self.push_times[uid] = int(time.time())
-            for card in cards:
-                msg = ''
-                url = []
-                uname = self.all_user_name[uid]
-                if card['desc']['timestamp'] < uid_time:
-                    break
-                dynamic_id = card['desc']['dynamic_id']
-                dynamic_type = card['desc']['type']
-                msg += uname + '发表了'
-                log.info(f"Got <Notification author={uname} type={dynamic_type}>")
-                content = json.loads(card['card'])
-                if dynamic_type == 2:  # 带图片动态
-                    msg += '动态：\n'
-                    pictures_count = content['item']['pictures_count']
-                    true_content = content['item']['description']
-                    true_content = self.get_limited_message(true_content)
-                    msg += true_content
-                    pictures = content['item']['pictures']
-                    if pictures_count > 0:
-                        is_big_picture = False
-                        first_picture_size = [pictures[0]['img_width'], pictures[0]['img_height']]
-                        if pictures_count >= 9:
-                            is_big_picture = True
-                            for i in range(9):
-                                if pictures[i]['img_width'] != first_picture_size[0] or pictures[i]['img_height'] != \
-                                        first_picture_size[1]:
-                                    is_big_picture = False
-                            if is_big_picture:
-                                picture_srcs = []
-                                for i in range(9):
-                                    picture_srcs.append(pictures[i]['img_src'])
-                                url = [await self.make_big_image(picture_srcs, first_picture_size, 9)]
-                        if pictures_count >= 6 and not is_big_picture:
-                            is_big_picture = True
-                            for i in range(6):
-                                if pictures[i]['img_width'] != first_picture_size[0] or pictures[i]['img_height'] != \
-                                        first_picture_size[1]:
-                                    is_big_picture = False
-                            if is_big_picture:
-                                picture_srcs = []
-                                for i in range(6):
-                                    picture_srcs.append(pictures[i]['img_src'])
-                                url = [await self.make_big_image(picture_srcs, first_picture_size, 6)]
-                                picture_srcs = []
-                                if pictures_count > 6:
-                                    for i in range(7, pictures_count):
-                                        picture_srcs.append(pictures[i]['img_src'])
-                        if not is_big_picture:
-                            if pictures_count > 0 and pictures_count < 4:
-                                url = []
-                                for pic in pictures:
-                                    url.append(pic['img_src'])
-                    msg += f'\nhttps://t.bilibili.com/{dynamic_id}'
-                elif dynamic_type == 4:  # 纯文字动态
-                    msg += '动态：\n'
-                    true_content = content['item']['content']
-                    true_content = self.get_limited_message(true_content)
-                    msg += true_content
-                    msg += f'\nhttps://t.bilibili.com/{dynamic_id}'
-                elif dynamic_type == 64:  # 文章
-                    msg += '文章：\n'
-                    cv_id = str(content['id'])
-                    title = content['title']
-                    summary = content['summary']
-                    url = [content['image_urls'][0]]
-                    msg += title + '\n' + summary + '……' + f'\nhttps://www.bilibili.com/read/cv{cv_id}'
-                elif dynamic_type == 8:  # 投稿视频
-                    msg += '视频：\n'
-                    bv_id = card['desc']['bvid']
-                    url = [content['pic']]
-                    msg += content['title'] + '\n' + self.get_limited_message(content['desc']) + '\n' + \
-                           f'\nhttps://www.bilibili.com/video/{bv_id}'
-                elif dynamic_type == 1:  # 转发动态
-                    msg += '转发动态：\n'
-                    msg += content['item']['content'] + '\n'
-                    origin_type = content['item']['orig_type']
-                    origin_content = json.loads(content['origin'])
-                    if origin_type == 2:
-                        origin_user = origin_content['user']['name']
-                        msg += '>>' + origin_user + ': /n'
-                        origin_true_content = origin_content['item']['description']
-                        origin_true_content = self.get_limited_message(origin_true_content)
-                        msg += origin_true_content
-                    elif origin_type == 4:
-                        origin_user = origin_content['user']['name']
-                        msg += '>>' + origin_user + ': /n'
-                        origin_true_content = origin_content['item']['content']
-                        origin_true_content = self.get_limited_message(origin_true_content)
-                        msg += origin_true_content
-                    elif origin_type == 8:
-                        bv_id = card['desc']['origin']['bvid']
-                        title = origin_content['title']
-                        cover_image = origin_content['pic']
-                        owner_name = origin_content['owner']['name']
-                        msg += '>>' + owner_name + '的视频:' + title + '\n' + '>>bv' + bv_id
-                    elif origin_type == 64:
-                        title = origin_content['title']
-                        cv_id = str(origin_content['id'])
-                        owner_name = origin_content['author']['name']
-                        msg += '>>' + owner_name + '的文章:' + title + '\n' + '>>cv' + cv_id
-                    else:
-                        msg += '>>暂不支持的源动态类型，请进入动态查看'
-                    msg += f'\nhttps://t.bilibili.com/{dynamic_id}'
-                else:
-                    msg += uname + f'发表了动态：\n暂不支持该动态类型，请进入原动态查看\nhttps://t.bilibili.com/{dynamic_id}'
+                res = await resp.json(loads=_loads)
+        if res is None:
+            log.warning(f'检查{uid}时出错 request response is None')
+            return
+        cards = res['data']['cards']
+        # cards=[res['data']['cards'][10]]
+        uid_time = self.push_times.get(uid, 0)
+        self.push_times[uid] = int(time.time())
+        for card in cards:
+            if card['desc']['timestamp'] < uid_time:
+                break
+            # push_times only needs to reach the disk once something got pushed
+            self._dirty = True
+            uname = self.all_user_name[uid]
+            dynamic_id = card['desc']['dynamic_id']
+            dynamic_type = card['desc']['type']
+            log.info(f"Got <Notification author={uname} type={dynamic_type}>")
+            content = _loads(card['card'])
+            handler = self._DYNAMIC_HANDLERS.get(dynamic_type, Bilibili._handle_unknown)
+            body, url = await handler(self, card, content)
+            msg = uname + '发表了' + body
+            if dynamic_type not in self._SELF_LINKED_TYPES:
+                msg += f'\nhttps://t.bilibili.com/{dynamic_id}'
+            await self.broadcast(uid, msg, url)
+
+    async def _poll_live(self, uid, sem):
+        try:
+            async with sem:
+                content = await self._fetch_acc_info(uid)
+            # the same response carries the name, keep it fresh while we're here
+            self.all_user_name[uid] = content['data']['name']
+            if content['data']['live_room'] is None:
+                return
+            if content['data']['live_room']['liveStatus'] == 1 and not self.room_states[uid]:
+                log.info(content['data']['live_room'])
+                self.room_states[uid] = True
+                self._dirty = True
+                username = self.all_user_name[uid]
+                msg = username + '开播了：\n' + content['data']['live_room']['title'] + '\n' \
+                      + content['data']['live_room']['url']
+                url = [content['data']['live_room']['cover']]
                 await self.broadcast(uid, msg, url)
-                await asyncio.sleep(0.5)
-        log.debug('B站动态检查结束')
-        log.debug('B站直播状态检查开始')
-        for uid in self.push_uid.keys():
-            try:
-                headers = {
-                    'Referer': 'https://space.bilibili.com/{user_uid}/'.format(user_uid=uid),
-                    'Cookie': self.bilibili_cookie
-                }
-                async with self.bot.session.get(
-                        'https://api.bilibili.com/x/space/acc/info',
-                        params={'mid': uid},
-                        headers=headers,
-                ) as resp:
-                    content = await resp.json()
-                if content['data']['live_room'] is None:
-                    continue
-                if content['data']['live_room']['liveStatus'] == 1 and not self.room_states[uid]:
-                    log.info(content['data']['live_room'])
-                    self.room_states[uid] = True
-                    username = self.all_user_name[uid]
-                    msg = username + '开播了：\n' + content['data']['live_room']['title'] + '\n' \
-                          + content['data']['live_room']['url']
-                    url = [content['data']['live_room']['cover']]
-                    await self.broadcast(uid, msg, url)
-                elif self.room_states[uid] and content['data']['live_room']['liveStatus'] == 0:
-                    self.room_states[uid] = False
-                    msg = content['data']['name'] + '下播了'
-                    await self.broadcast(uid, msg, None)
-                await asyncio.sleep(0.5)
-            except Exception as _:
-                log.warning(f'B站直播检查发生错误 uid={uid}\n' + traceback.format_exc())
-        log.debug('B站直播状态检查结束')
+            elif self.room_states[uid] and content['data']['live_room']['liveStatus'] == 0:
+                self.room_states[uid] = False
+                self._dirty = True
+                msg = content['data']['name'] + '下播了'
+                await self.broadcast(uid, msg, None)
+        except Exception as _:
+            log.warning(f'B站直播检查发生错误 uid={uid}\n' + traceback.format_exc())
+
+    async def _check_bili_dynamic(self):
+        # only a handful of requests are let through at once so we don't
+        # hammer the bilibili API when there are a lot of subscriptions
+        sem = asyncio.Semaphore(8)
+        uids = list(self.push_uid)
+
+        log.debug('B站动态与直播状态检查开始')
+        # both checks for every uid share the one pass, _poll_live handles its own errors
+        results = await asyncio.gather(
+            *(self._poll_dynamic(uid, sem) for uid in uids),
+            *(self._poll_live(uid, sem) for uid in uids),
+            return_exceptions=True
+        )
+        for uid, result in zip(uids, results):
+            if isinstance(result, Exception):
+                log.warning(f'B站动态检查发生错误 uid={uid}', exc_info=result)
+        log.debug('B站动态与直播状态检查结束')
+        # the session's connector keeps these alive for the next check
+        connector = self.bot.session.connector
+        log.debug('%s 个可复用的 HTTP 连接', sum(len(conns) for conns in connector._conns.values()))
         await self.save_config()
 
     @tasks.loop(minutes=1)
@@ -324,15 +397,15 @@ class Bilibili(commands.Cog):
                 self.push_uid[uid].append(str(ctx.channel.id))
             await self.load_username(uid)
             self.push_times[uid] = int(time.time())
-            await self.load_all_username()
             await ctx.reply(f'{self.all_user_name[uid]} ({uid}) 订阅成功')
+            self._dirty = True
         await self.save_config()
 
     @status.command(name='取消', hidden=True)
     @commands.is_owner()
     async def _cancel_sub(self, ctx: commands.Context, uids: commands.Greedy[int]):
         for uid in uids:
-            if uid in self.push_uid.keys():
+            if uid in self.push_uid:
                 if str(ctx.channel.id) in self.push_uid[uid]:
                     if len(self.push_uid[uid]) == 1:
                         self.push_uid.pop(uid)
@@ -344,8 +417,9 @@ class Bilibili(commands.Cog):
             else:
                 await ctx.reply(f'{uid} 取消订阅失败：未找到该订阅')
                 continue
-            await self.load_all_username()
+            await self.load_username(uid)
             await ctx.reply(f'{self.all_user_name[uid]} ({uid}) 取消订阅成功')
+            self._dirty = True
         await self.save_config()
 
 
@@ -1,9 +1,9 @@
 import asyncio
 import datetime
+import heapq
 import io
 import logging
-from collections import defaultdict
-from typing import Optional, List
+from typing import Optional, List, NamedTuple
 
 import asyncpg
 import cv2
@@ -31,6 +31,25 @@ class Pixels(db.Table):
     time = db.Column(db.Datetime)
 
 
+class PixelRecord(NamedTuple):
+    # same order as the INSERT in bulk_insert
+    painter: str
+    painter_guild: str
+    x: int
+    y: int
+    color: int
+    time: datetime.datetime
+
+
+def _pixel_key(x, y):
+    return (x << 16) | y
+
+
+def _encode_jpeg(img: numpy.ndarray, quality: int = 90) -> bytes:
+    _, buffer = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return buffer.tobytes()
+
+
 class PixelWar(commands.Cog):
     def __init__(self, bot: BeepBoopFox):
         self.bot = bot
@@ -42,15 +61,21 @@ class PixelWar(commands.Cog):
         self._batch_lock = asyncio.Lock(loop=bot.loop)
         self.bulk_insert_loop.add_exception_type(asyncpg.PostgresConnectionError)
         self.bulk_insert_loop.start()
+        # (due, channel_id, mention) for "your next pixel is ready" messages
+        self._reminders = []
+        self._have_reminders = asyncio.Event(loop=bot.loop)
+        self._reminder_task = bot.loop.create_task(self.dispatch_reminders())
         self.color_tree = cKDTree(Colors)
 
-        self.pixels = numpy.zeros([self.max_x, self.max_y, 3], dtype=numpy.uint8)
-        self.pixel_data = defaultdict(lambda: defaultdict())
-        self.pixels.fill(255)
+        # indexed as pixels[y, x], so rows come first
+        self.pixels = numpy.full((self.max_y, self.max_x, 3), 255, dtype=numpy.uint8)
+        # _pixel_key(x, y): PixelRecord of who painted the pixel
+        self.pixel_data = {}
 
     def cog_unload(self):
         self.filled_in = False
         self.bulk_insert_loop.stop()
+        self._reminder_task.cancel()
 
     @tasks.loop(seconds=10.0)
     async def bulk_insert_loop(self):
@@ -62,35 +87,69 @@ class PixelWar(commands.Cog):
             await self.bulk_insert()
 
     async def bulk_insert(self):
-        query = """INSERT INTO pixels (painter, painter_guild, x, y, color, time) 
-                   SELECT k.painter, k.painter_guild, k.x, k.y, k.color, k.time
-                   FROM jsonb_to_recordset($1::jsonb) AS
-                   k(painter TEXT, painter_guild TEXT, x INT, y INT, color INT, time TIMESTAMP)
-                   ON CONFLICT (x, y) DO UPDATE 
+        query = """INSERT INTO pixels (painter, painter_guild, x, y, color, time)
+                   VALUES ($1, $2, $3, $4, $5, $6)
+                   ON CONFLICT (x, y) DO UPDATE
                    SET painter = excluded.painter, painter_guild = excluded.painter_guild,
                     color = excluded.color, time = excluded.time
                 """
 
-        if self._batch_changes:
-            await self.bot.pool.execute(query, self._batch_changes)
-            total = len(self._batch_changes)
-            if total > 1:
-                log.info('已将 %s 像素注册到数据库。', total)
-            self._batch_changes.clear()
+        if not self._batch_changes:
+            return
+
+        # swap the batch out so draws made while this runs go into the next one
+        batch, self._batch_changes = self._batch_changes, []
+        try:
+            async with self.bot.pool.acquire() as con:
+                await con.executemany(query, batch)
+        except asyncpg.PostgresConnectionError:
+            # put them back in front of any newer draws so the next run retries them
+            self._batch_changes[:0] = batch
+            raise
+
+        total = len(batch)
+        if total > 1:
+            log.info('已将 %s 像素注册到数据库。', total)
+
+    async def dispatch_reminders(self):
+        while True:
+            if not self._reminders:
+                self._have_reminders.clear()
+                await self._have_reminders.wait()
+                continue
+
+            delay = self._reminders[0][0] - self.bot.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, channel_id, mention = heapq.heappop(self._reminders)
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                continue
+            try:
+                await channel.send(f"{mention} 你的下一笔已经准备好了！")
+            except qq.HTTPException:
+                pass
+            except Exception:
+                # this one task serves every reminder, it mustn't die on a single send
+                log.exception('无法在频道 %s 发送提醒。', channel_id)
 
     async def fill_in_pixels(self):
-        query = "SELECT * FROM pixels"
+        query = "SELECT painter, painter_guild, x, y, color, time FROM pixels"
         colors: List[Record] = await self.bot.pool.fetch(query)
-        for color in colors:
-            self.pixel_data[color['x']][color['y']] = {
-                'color': color['color'],
-                'painter': color['painter'],
-                'painter_guild': color['painter_guild'],
-                'time': color['time']
-            }
-            if color['color'] == 31:
-                continue
-            self.pixels[color['y'], color['x']] = Colors[color['color']]
+        self.pixel_data.update({
+            _pixel_key(color['x'], color['y']): PixelRecord(*color)
+            for color in colors
+        })
+
+        total = len(colors)
+        xs = numpy.fromiter((color['x'] for color in colors), dtype=numpy.intp, count=total)
+        ys = numpy.fromiter((color['y'] for color in colors), dtype=numpy.intp, count=total)
+        codes = numpy.fromiter((color['color'] for color in colors), dtype=numpy.intp, count=total)
+        # the canvas starts out white, so there is nothing to paint for those
+        mask = codes != 31
+        self.pixels[ys[mask], xs[mask]] = Colors[codes[mask]]
         log.info("Fill in completed")
 
     @commands.command(name="帮助")
@@ -125,63 +184,52 @@ class PixelWar(commands.Cog):
             return await ctx.send("你这中心都超出最大范围了！")
         if radius > 100:
             return await ctx.send("范围太大了！")
+        data = await self.bot.loop.run_in_executor(None, self.render_canvas, x, y, radius, grid)
+        file = qq.File(io.BytesIO(data))
+        await ctx.send(file=file)
+
+    def render_canvas(self, x: int, y: int, radius: int, grid: bool) -> bytes:
         x_max = min(self.max_x, x + radius + 1)
         x_min = max(0, x - radius)
         y_max = min(self.max_y, y + radius + 1)
         y_min = max(0, y - radius)
         size = (1 + radius * 2)
         half_size = size * 10
-        img = self.pixels[y_min:y_max, x_min:x_max]
-        img = numpy.pad(
-            img,
-            [
-                (max(0, radius - y), max(0, y + radius - self.max_y - 1)),
-                (max(0, radius - x), max(0, x + radius - self.max_x - 1)),
-                (0, 0)
-            ],
-            'constant', constant_values=(0, 0)
-        )
+        # anything outside of the canvas stays black
+        img = numpy.zeros((size, size, 3), dtype=numpy.uint8)
+        top = y_min - (y - radius)
+        left = x_min - (x - radius)
+        img[top:top + y_max - y_min, left:left + x_max - x_min] = self.pixels[y_min:y_max, x_min:x_max]
 
-        img: numpy.ndarray = cv2.resize(img, dsize=(size * 20, size * 20), interpolation=cv2.INTER_AREA)
+        # every pixel becomes a 20x20 block, no interpolation wanted for pixel art
+        img = img.repeat(20, axis=0).repeat(20, axis=1)
         if grid and radius < 30:
             img[::20].fill(200)
             img[:, ::20].fill(200)
 
         img[half_size - 5:half_size + 5, half_size - 5:half_size + 5] = 255 - img[half_size, half_size]
-
-        retval, buffer = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
-        file = qq.File(io.BytesIO(buffer.tobytes()))
-        await ctx.send(file=file)
+        return _encode_jpeg(img)
 
     @commands.guild_only()
     @commands.cooldown(rate=1, per=180, type=BucketType.user)
     @commands.command(name="画图")
     async def draw_canvas(self, ctx: Context, x: int, y: int, color: int, grid: Optional[bool] = False):
         now = datetime.datetime.now()
-        if 0 >= x >= self.max_x or 0 >= y >= self.max_y:
+        if not (0 <= x < self.max_x and 0 <= y < self.max_y):
             return await ctx.send("你想设置的位置超出了上限！")
-        try:
-            self.pixels[y, x] = Colors[color]
-        except IndexError:
+        # negative indices would silently wrap around, so check the range up front
+        if not 0 <= color < len(Colors):
             return await ctx.send("不支持该色号！")
-        self._batch_changes.append({
-            'x': x,
-            'y': y,
-            'color': color,
-            'painter': ctx.author.display_name,
-            'painter_guild': ctx.guild.name,
-            'time': now.isoformat()
-        })
-        self.pixel_data[x][y] = {
-            'color': color,
-            'painter': ctx.author.display_name,
-            'painter_guild': ctx.guild.name,
-            'time': now
-        }
+        self.pixels[y, x] = Colors[color]
+        # the same row is queued for the database and kept for /查像素
+        record = PixelRecord(ctx.author.display_name, ctx.guild.name, x, y, color, now)
+        self._batch_changes.append(record)
+        self.pixel_data[_pixel_key(x, y)] = record
         await ctx.send(f"成功在 ({x},{y}) 画上色号 {color} !")
         await self.view_canvas(ctx, x, y, grid=grid)
-        await asyncio.sleep(180)
-        await ctx.send(f"{ctx.author.mention} 你的下一笔已经准备好了！")
+        due = self.bot.loop.time() + 180
+        heapq.heappush(self._reminders, (due, ctx.channel.id, ctx.author.mention))
+        self._have_reminders.set()
 
     async def cog_command_error(self, ctx: Context, error: Exception):
         if isinstance(error, commands.CommandOnCooldown):
@@ -192,35 +240,41 @@ class PixelWar(commands.Cog):
     @commands.guild_only()
     @commands.command(name="查像素")
     async def check_pixel(self, ctx: Context, x: int, y: int):
-        if y not in self.pixel_data[x]:
+        result = self.pixel_data.get(_pixel_key(x, y))
+        if result is None:
             return await ctx.send("该位置还没有人画上像素，赶紧来画一下吧。")
-        result = self.pixel_data[x][y]
         await ctx.send(
-            f"位置 ({x},{y}) 由 {result['painter_guild']} 的 {result['painter']} "
-            f"于 {result['time'].strftime('%m/%d/%Y, %H:%M:%S')} 绘制为 色号{result['color']}。"
+            f"位置 ({x},{y}) 由 {result.painter_guild} 的 {result.painter} "
+            f"于 {result.time.strftime('%m/%d/%Y, %H:%M:%S')} 绘制为 色号{result.color}。"
         )
         await self.view_canvas(ctx, x, y, True)
 
     @commands.cooldown(rate=1, per=300, type=BucketType.user)
     @commands.command(name="全图")
     async def full_map(self, ctx: Context):
-        img = cv2.resize(self.pixels, dsize=(self.max_y * 10, self.max_x * 10), interpolation=cv2.INTER_AREA)
-        res = numpy.pad(img, ((20, 20), (20, 20), (0, 0)), 'constant', constant_values=0)
-        retval, buffer = cv2.imencode('.jpg', res, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
-        file = qq.File(io.BytesIO(buffer.tobytes()))
+        data = await self.bot.loop.run_in_executor(None, self.render_full_map)
+        file = qq.File(io.BytesIO(data))
         await ctx.send(file=file)
 
+    def render_full_map(self) -> bytes:
+        res = numpy.zeros((self.max_y * 10 + 40, self.max_x * 10 + 40, 3), dtype=numpy.uint8)
+        res[20:-20, 20:-20] = self.pixels.repeat(10, axis=0).repeat(10, axis=1)
+        return _encode_jpeg(res)
+
     @commands.command(name="像素化")
     async def pixelizer(self, ctx: Context):
         if not ctx.message.attachments:
             return await ctx.send("请附带一个图片")
         image = await ctx.message.attachments[0].read()
-        image = cv2.imdecode(numpy.frombuffer(image, numpy.uint8), cv2.IMREAD_COLOR)
-        image = Colors[self.color_tree.query(image, k=1)[1]]
-        _, buffer = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
-        file = qq.File(io.BytesIO(buffer.tobytes()))
+        data = await self.bot.loop.run_in_executor(None, self.pixelize, image)
+        file = qq.File(io.BytesIO(data))
         await ctx.send(file=file)
 
+    def pixelize(self, data: bytes) -> bytes:
+        image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_COLOR)
+        image = Colors[self.color_tree.query(image, k=1)[1]]
+        return _encode_jpeg(image)
+
 
 def setup(bot):
     bot.add_cog(PixelWar(bot))
@@ -1,9 +1,11 @@
 import asyncio
 import datetime
 import gc
+import heapq
 import io
 import itertools
 import logging
+import operator
 import os
 import re
 import sys
@@ -21,6 +23,11 @@ from qq.ext import commands, tasks
 
 from .utils import db, time, formats
 
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 log = logging.getLogger(__name__)
 
 LOGGING_CHANNEL = 309632009427222529
@@ -32,7 +39,14 @@ class GatewayHandler(logging.Handler):
         super().__init__(logging.INFO)
 
     def filter(self, record):
-        return record.name == 'qq.gateway' or 'Shard ID' in record.msg or 'Websocket closed ' in record.msg
+        # this runs for every record in the process, so check the cheap things first
+        if record.name == 'qq.gateway':
+            return True
+        # bot.py logs its own shard resumes
+        if record.name != 'bot' and not record.name.startswith('qq.'):
+            return False
+        msg = record.msg
+        return isinstance(msg, str) and msg.startswith(('Shard ID', 'Websocket closed '))
 
     def emit(self, record):
         self.cog.add_record(record)
@@ -48,9 +62,23 @@ class Commands(db.Table):
     prefix = db.Column(db.String)
     command = db.Column(db.String, index=True)
     failed = db.Column(db.Boolean, index=True)
+    # how many identical uses within the same minute this row stands for
+    count = db.Column(db.Integer, default=1, nullable=False)
+
+    @classmethod
+    def create_table(cls, *, exists_ok=True):
+        statement = super().create_table(exists_ok=exists_ok)
+
+        # rows only ever get appended in time order, so a BRIN index on used
+        # narrows the "last day" queries to the newest block ranges cheaply
+        sql = "CREATE INDEX IF NOT EXISTS commands_used_brin_idx ON commands USING BRIN (used) " \
+              "WITH (pages_per_range=32);\n" \
+              "CREATE INDEX IF NOT EXISTS commands_guild_id_used_idx ON commands (guild_id, used DESC);"
+        return statement + '\n' + sql
 
 
-_INVITE_REGEX = re.compile(r'(?:https?:\/\/)?qq(?:\.gg|\.com|app\.com\/invite)?\/[A-Za-z0-9]+')
+# google-re2 matches this in linear time, plain re is the fallback
+_INVITE_REGEX = (re2 or re).compile(r'(?:https?://)?qq(?:\.gg|\.com|app\.com/invite)?/[A-Za-z0-9]+')
 
 
 def censor_invite(obj, *, _regex=_INVITE_REGEX):
@@ -61,44 +89,185 @@ def hex_value(arg):
     return int(arg, base=16)
 
 
-def object_at(addr):
+def partition_sections(records):
+    """Splits the rows of a fused stats query by their ``section`` column, highest uses first."""
+    sections = defaultdict(list)
+    for record in records:
+        sections[record['section']].append(record)
+    for rows in sections.values():
+        rows.sort(key=lambda r: r['uses'] or 0, reverse=True)
+    return sections
+
+
+def object_at(addr, *, loop=None):
+    # asyncio already keeps every pending task in a weak set, which is
+    # far smaller than the whole heap
+    for task in asyncio.all_tasks(loop):
+        if id(task) == addr:
+            return task
+
+    # finished tasks drop out of that set, those still need the slow way
     for o in gc.get_objects():
         if id(o) == addr:
             return o
     return None
 
 
+# queries used by the owner-only command_history commands
+_HISTORY_RECENT_QUERY = """SELECT
+                                CASE failed
+                                    WHEN TRUE THEN command || ' [!]'
+                                    ELSE command
+                                END AS "command",
+                                to_char(used, 'Mon DD HH12:MI:SS AM') AS "invoked",
+                                author_id,
+                                guild_id
+                           FROM commands
+                           ORDER BY used DESC
+                           LIMIT 15;
+                        """
+
+_HISTORY_FOR_QUERY = """SELECT *, t.success + t.failed AS "total"
+                        FROM (
+                            SELECT guild_id,
+                                   SUM(CASE WHEN failed THEN 0 ELSE count END) AS "success",
+                                   SUM(CASE WHEN failed THEN count ELSE 0 END) AS "failed"
+                            FROM commands
+                            WHERE command=$1
+                            AND used > (CURRENT_TIMESTAMP - $2::interval)
+                            GROUP BY guild_id
+                        ) AS t
+                        ORDER BY "total" DESC
+                        LIMIT 30;
+                     """
+
+_HISTORY_GUILD_QUERY = """SELECT
+                               CASE failed
+                                   WHEN TRUE THEN command || ' [!]'
+                                   ELSE command
+                               END AS "command",
+                               channel_id,
+                               author_id,
+                               used
+                          FROM commands
+                          WHERE guild_id=$1
+                          ORDER BY used DESC
+                          LIMIT 15;
+                       """
+
+_HISTORY_USER_QUERY = """SELECT
+                              CASE failed
+                                  WHEN TRUE THEN command || ' [!]'
+                                  ELSE command
+                              END AS "command",
+                              guild_id,
+                              used
+                         FROM commands
+                         WHERE author_id=$1
+                         ORDER BY used DESC
+                         LIMIT 20;
+                      """
+
+_HISTORY_LOG_QUERY = """SELECT command, SUM(count)
+                        FROM commands
+                        WHERE used > (CURRENT_TIMESTAMP - $1::interval)
+                        GROUP BY command
+                     """
+
+_HISTORY_COG_QUERY = """SELECT *, t.success + t.failed AS "total"
+                        FROM (
+                            SELECT command,
+                                   SUM(CASE WHEN failed THEN 0 ELSE count END) AS "success",
+                                   SUM(CASE WHEN failed THEN count ELSE 0 END) AS "failed"
+                            FROM commands
+                            WHERE command = any($1::text[])
+                            AND used > (CURRENT_TIMESTAMP - $2::interval)
+                            GROUP BY command
+                        ) AS t
+                        ORDER BY "total" DESC
+                        LIMIT 30;
+                     """
+
+_HISTORY_COGS_QUERY = """SELECT COALESCE(m.cog, 'No Cog') AS "cog",
+                                SUM(CASE WHEN c.failed THEN 0 ELSE c.count END) AS "success",
+                                SUM(CASE WHEN c.failed THEN c.count ELSE 0 END) AS "failed",
+                                SUM(c.count) AS "total"
+                         FROM commands c
+                         LEFT JOIN unnest($2::text[], $3::text[]) AS m(command, cog) ON m.command = c.command
+                         WHERE c.used > (CURRENT_TIMESTAMP - $1::interval)
+                         GROUP BY 1
+                         ORDER BY "total" DESC;
+                      """
+
+
 class Stats(commands.Cog):
     """Bot usage statistics."""
 
     def __init__(self, bot):
         self.bot = bot
         self.process = psutil.Process()
-        self._batch_lock = asyncio.Lock(loop=bot.loop)
         self._data_batch = []
         self.bulk_insert_loop.add_exception_type(asyncpg.PostgresConnectionError)
         self.bulk_insert_loop.start()
         self._gateway_queue = asyncio.Queue(loop=bot.loop)
         self.gateway_worker.start()
+        # running member/text/voice totals for about, built on first use
+        self._counts = None
+        # guild_id: number of bots, counted once per guild then kept up to date
+        self._bot_counts = {}
+        # opened on first use, deployments without a checkout only lose the commit listing
+        self._repo = None
+        # (loop time, count, commits) of the last walk
+        self._commits_cache = (0.0, 0, None)
+        # commit hex: (markdown link and summary, commit time in UTC)
+        self._commit_line_cache = {}
+        # qualified name: command, rebuilt whenever the loaded cogs change
+        self._cmd_map = {}
+        self._cmd_map_cogs = None
+        # bumped every time the map is rebuilt
+        self._cmd_map_version = 0
+        # (command_history subcommand, days, ...): (loop time, records)
+        self._history_cache = {}
 
     @property
     def display_emoji(self) -> qq.PartialEmoji:
         return qq.PartialEmoji.from_str('\N{BAR CHART}')
 
     async def bulk_insert(self):
-        query = """INSERT INTO commands (guild_id, channel_id, author_id, used, prefix, command, failed)
-                   SELECT x.guild, x.channel, x.author, x.used, x.prefix, x.command, x.failed
-                   FROM jsonb_to_recordset($1::jsonb) AS
-                   x(guild DECIMAL(38,0), channel DECIMAL(38,0), author DECIMAL(38,0), used TIMESTAMP, prefix TEXT, command TEXT, 
-                   failed BOOLEAN)
-                """
+        if not self._data_batch:
+            return
+
+        # swap the batch out so commands can keep appending while we copy
+        batch, self._data_batch = self._data_batch, []
+        # fold repeated uses into one row per minute, readers SUM(count) them
+        counter = Counter(
+            (guild_id, channel_id, author_id, used.replace(second=0, microsecond=0), prefix, command, failed)
+            for guild_id, channel_id, author_id, used, prefix, command, failed in batch
+        )
+        records = [(*key, count) for key, count in counter.items()]
+        try:
+            # binary COPY, no JSON to build here or to parse on the server
+            async with self.bot.pool.acquire() as con:
+                await con.copy_records_to_table(
+                    'commands',
+                    records=records,
+                    columns=('guild_id', 'channel_id', 'author_id', 'used', 'prefix', 'command', 'failed', 'count'),
+                    timeout=30
+                )
+        except (asyncpg.PostgresConnectionError, OSError, asyncio.TimeoutError):
+            # put them back so the next run retries them, the loop carries on after these
+            self._data_batch[:0] = batch
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # anything else is a problem with the rows themselves and retrying won't help
+            log.exception('无法将 %s 命令注册到数据库，已丢弃。', len(batch))
+            return
 
-        if self._data_batch:
-            await self.bot.pool.execute(query, self._data_batch)
-            total = len(self._data_batch)
-            if total > 1:
-                log.info('已将 %s 命令注册到数据库。', total)
-            self._data_batch.clear()
+        total = len(batch)
+        if total > 1:
+            log.info('已将 %s 命令注册到数据库（%s 行）。', total, len(records))
 
     def cog_unload(self):
         self.bulk_insert_loop.stop()
@@ -106,13 +275,18 @@ class Stats(commands.Cog):
 
     @tasks.loop(seconds=10.0)
     async def bulk_insert_loop(self):
-        async with self._batch_lock:
-            await self.bulk_insert()
+        await self.bulk_insert()
 
     @tasks.loop(seconds=0.0)
     async def gateway_worker(self):
-        record = await self._gateway_queue.get()
-        await self.notify_gateway_status(record)
+        # wake up once per burst rather than once per log line
+        records = [await self._gateway_queue.get()]
+        while len(records) < 10:
+            try:
+                records.append(self._gateway_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        await self.notify_gateway_status(records)
 
     async def register_command(self, ctx):
         if ctx.command is None:
@@ -130,16 +304,10 @@ class Stats(commands.Cog):
             guild_id = ctx.guild.id
 
         log.info(f'{message.created_at}: {message.author} 在 {destination} 运行 {message.content}')
-        async with self._batch_lock:
-            self._data_batch.append({
-                'guild': guild_id,
-                'channel': ctx.channel.id,
-                'author': ctx.author.id,
-                'used': message.created_at.isoformat(),
-                'prefix': ctx.prefix,
-                'command': command,
-                'failed': ctx.command_failed,
-            })
+        # same column order as the COPY in bulk_insert
+        self._data_batch.append(
+            (guild_id, ctx.channel.id, ctx.author.id, message.created_at, ctx.prefix, command, ctx.command_failed)
+        )
 
     @commands.Cog.listener()
     async def on_command_completion(self, ctx):
@@ -149,6 +317,94 @@ class Stats(commands.Cog):
     async def on_socket_event_type(self, event_type):
         self.bot.socket_stats[event_type] += 1
 
+    def get_command_map(self):
+        # reloading an extension creates new cog objects, so compare the objects
+        # themselves, ids can be reused once the old cog is freed
+        cogs = tuple(self.bot.cogs.values())
+        cached = self._cmd_map_cogs
+        if cached is None or len(cached) != len(cogs) or any(a is not b for a, b in zip(cached, cogs)):
+            self._cmd_map = {c.qualified_name: c for c in self.bot.walk_commands()}
+            self._cmd_map_cogs = cogs
+            self._cmd_map_version += 1
+        return self._cmd_map
+
+    @staticmethod
+    def _channel_kind(channel):
+        if isinstance(channel, qq.TextChannel):
+            return 'text'
+        if isinstance(channel, qq.VoiceChannel):
+            return 'voice'
+        return None
+
+    def _count_guild(self, guild):
+        counts = Counter()
+        if guild.unavailable:
+            return counts
+
+        counts['members'] = guild.member_count
+        for channel in guild.channels:
+            kind = self._channel_kind(channel)
+            if kind is not None:
+                counts[kind] += 1
+        return counts
+
+    def get_counts(self):
+        if self._counts is None:
+            self._counts = Counter()
+            for guild in self.bot.guilds:
+                self._counts.update(self._count_guild(guild))
+        return self._counts
+
+    def get_bot_count(self, guild):
+        try:
+            return self._bot_counts[guild.id]
+        except KeyError:
+            count = self._bot_counts[guild.id] = sum(m.bot for m in guild.members)
+            return count
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # the cache was rebuilt from scratch, so recount lazily
+        self._counts = None
+        self._bot_counts.clear()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        if self._counts is not None:
+            self._counts.update(self._count_guild(guild))
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self._bot_counts.pop(guild.id, None)
+        if self._counts is not None:
+            self._counts.subtract(self._count_guild(guild))
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        kind = self._channel_kind(channel)
+        if self._counts is not None and kind is not None:
+            self._counts[kind] += 1
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        kind = self._channel_kind(channel)
+        if self._counts is not None and kind is not None:
+            self._counts[kind] -= 1
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if self._counts is not None:
+            self._counts['members'] += 1
+        if member.bot and member.guild.id in self._bot_counts:
+            self._bot_counts[member.guild.id] += 1
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        if self._counts is not None:
+            self._counts['members'] -= 1
+        if member.bot and member.guild.id in self._bot_counts:
+            self._bot_counts[member.guild.id] -= 1
+
     async def log_error(self, *, ctx=None, extra=None):
         e = qq.Embed(title='Error', colour=0xdd5f53)
         e.description = f'```py\n{traceback.format_exc()}\n```'
@@ -176,14 +432,17 @@ class Stats(commands.Cog):
         This is only for the current session.
         """
         counter = self.bot.command_stats
-        width = len(max(counter, key=len))
-        total = sum(counter.values())
 
+        # most_common(n) is already heapq.nlargest, do the same for the bottom
         if limit > 0:
             common = counter.most_common(limit)
+        elif limit == 0:
+            common = counter.most_common()
         else:
-            common = counter.most_common()[limit:]
+            common = heapq.nsmallest(-limit, counter.items(), key=operator.itemgetter(1))[::-1]
 
+        # only the rows being shown need to line up
+        width = max((len(k) for k, _ in common), default=0)
         output = '\n'.join(f'{k:<{width}}: {c}' for k, c in common)
 
         await ctx.reply(f'```\n{output}\n```')
@@ -205,18 +464,34 @@ class Stats(commands.Cog):
         await ctx.reply(f'Uptime: **{self.get_bot_uptime()}**')
 
     def format_commit(self, commit):
-        short, _, _ = commit.message.partition('\n')
-        short_sha2 = commit.hex[0:6]
-        commit_tz = datetime.timezone(datetime.timedelta(minutes=commit.commit_time_offset))
-        commit_time = datetime.datetime.fromtimestamp(commit.commit_time).astimezone(commit_tz)
+        # commits never change, only the relative offset has to be redone
+        try:
+            line, commit_time = self._commit_line_cache[commit.hex]
+        except KeyError:
+            short, _, _ = commit.message.partition('\n')
+            short_sha2 = commit.hex[0:6]
+            commit_tz = datetime.timezone(datetime.timedelta(minutes=commit.commit_time_offset))
+            commit_time = datetime.datetime.fromtimestamp(commit.commit_time).astimezone(commit_tz)
+            commit_time = commit_time.astimezone(datetime.timezone.utc)
+            line = f'[`{short_sha2}`](https://github.com/foxwhite25/BeepBoopFox/commit/{commit.hex}) {short}'
+            self._commit_line_cache[commit.hex] = (line, commit_time)
 
         # [`hash`](url) message (offset)
-        offset = time.format_relative(commit_time.astimezone(datetime.timezone.utc))
-        return f'[`{short_sha2}`](https://github.com/foxwhite25/BeepBoopFox/commit/{commit.hex}) {short} ({offset})'
+        offset = time.format_relative(commit_time)
+        return f'{line} ({offset})'
 
     def get_last_commits(self, count=3):
-        repo = pygit2.Repository('.git')
+        # history only changes on deploy, no need to walk it for every call
+        now = self.bot.loop.time()
+        cached_at, cached_count, commits = self._commits_cache
+        if commits is not None and cached_count == count and now - cached_at < 300:
+            return commits
+
+        repo = self._repo
+        if repo is None:
+            repo = self._repo = pygit2.Repository('.git')
         commits = list(itertools.islice(repo.walk(repo.head.target, pygit2.GIT_SORT_TOPOLOGICAL), count))
+        self._commits_cache = (now, count, commits)
         return commits
 
     @commands.command()
@@ -230,27 +505,13 @@ class Stats(commands.Cog):
         )
 
         # statistics
-        total_members = 0
-
-        text = 0
-        voice = 0
-        guilds = 0
-        for guild in self.bot.guilds:
-            guilds += 1
-            if guild.unavailable:
-                continue
-
-            total_members += guild.member_count
-            for channel in guild.channels:
-                if isinstance(channel, qq.TextChannel):
-                    text += 1
-                elif isinstance(channel, qq.VoiceChannel):
-                    voice += 1
+        counts = self.get_counts()
+        guilds = len(self.bot.guilds)
 
-        embed.add_field(name=f'成员:\n{total_members} ')
-        embed.add_field(name=f'子频道:\n{text + voice} ')
+        embed.add_field(name=f'成员:\n{counts["members"]} ')
+        embed.add_field(name=f'子频道:\n{counts["text"] + counts["voice"]} ')
 
-        memory_usage = self.process.memory_full_info().uss / 1024 ** 2
+        memory_usage = self.process.memory_info().rss / 1024 ** 2
         cpu_usage = self.process.cpu_percent() / psutil.cpu_count()
         embed.add_field(name=f'进程:\n{memory_usage:.2f} MiB\n{cpu_usage:.2f}% CPU')
 
@@ -263,7 +524,7 @@ class Stats(commands.Cog):
         await ctx.reply(embed=embed)
 
     def censor_object(self, obj):
-        if not isinstance(obj, str) and obj.id in self.bot.blacklist:
+        if not isinstance(obj, str) and obj.id in self.bot._blacklist_ids:
             return '[censored]'
         return censor_invite(obj)
 
@@ -278,75 +539,47 @@ class Stats(commands.Cog):
 
         embed = qq.Embed(title='频道命令统计', colour=qq.Colour.blurple())
 
-        # total command uses
-        query = "SELECT COUNT(*), MIN(used) FROM commands WHERE guild_id=$1;"
-        count = await ctx.db.fetchrow(query, ctx.guild.id)
-
-        embed.add_field(name=f'{count[0]} 使用的命令：\n')
-
-        query = """SELECT command,
-                          COUNT(*) as "uses"
-                   FROM commands
-                   WHERE guild_id=$1
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
+        # everything in one round trip, told apart by the section column
+        query = """WITH base AS (
+                       SELECT command, author_id, used, count FROM commands WHERE guild_id=$1
+                   ), today AS (
+                       SELECT * FROM base WHERE used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
+                   )
+                   (SELECT 'total' AS section, NULL::text AS command, NULL::numeric AS author_id,
+                           COALESCE(SUM(count), 0) AS uses
+                    FROM base)
+                   UNION ALL
+                   (SELECT 'command', command, NULL, SUM(count) AS uses
+                    FROM base GROUP BY command ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'command_today', command, NULL, SUM(count) AS uses
+                    FROM today GROUP BY command ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'author', NULL, author_id, SUM(count) AS uses
+                    FROM base GROUP BY author_id ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'author_today', NULL, author_id, SUM(count) AS uses
+                    FROM today GROUP BY author_id ORDER BY uses DESC LIMIT 5);
                 """
+        sections = partition_sections(await ctx.db.fetch(query, ctx.guild.id))
 
-        records = await ctx.db.fetch(query, ctx.guild.id)
-
-        value = '\n'.join(f'{lookup[index]}: {command} ({uses} 次使用)'
-                          for (index, (command, uses)) in enumerate(records)) or '没有命令。'
+        # total command uses
+        embed.add_field(name=f'{sections["total"][0]["uses"]} 使用的命令：\n')
 
+        value = '\n'.join(f'{lookup[index]}: {r["command"]} ({r["uses"]} 次使用)'
+                          for (index, r) in enumerate(sections['command'])) or '没有命令。'
         embed.add_field(name='最强命令: \n' + value)
 
-        query = """SELECT command,
-                          COUNT(*) as "uses"
-                   FROM commands
-                   WHERE guild_id=$1
-                   AND used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query, ctx.guild.id)
-
-        value = '\n'.join(f'{lookup[index]}: {command} ({uses} 次使用)'
-                          for (index, (command, uses)) in enumerate(records)) or '没有命令。'
+        value = '\n'.join(f'{lookup[index]}: {r["command"]} ({r["uses"]} 次使用)'
+                          for (index, r) in enumerate(sections['command_today'])) or '没有命令。'
         embed.add_field(name='今天的最强命令: \n' + value)
 
-        query = """SELECT author_id,
-                          COUNT(*) AS "uses"
-                   FROM commands
-                   WHERE guild_id=$1
-                   GROUP BY author_id
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query, ctx.guild.id)
-
-        value = '\n'.join(f'{lookup[index]}: <@!{author_id}> ({uses} 次使用)'
-                          for (index, (author_id, uses)) in enumerate(records)) or '没有机器人使用者。'
-
+        value = '\n'.join(f'{lookup[index]}: <@!{r["author_id"]}> ({r["uses"]} 次使用)'
+                          for (index, r) in enumerate(sections['author'])) or '没有机器人使用者。'
         embed.add_field(name='最强命令使用者: \n' + value)
 
-        query = """SELECT author_id,
-                          COUNT(*) AS "uses"
-                   FROM commands
-                   WHERE guild_id=$1
-                   AND used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
-                   GROUP BY author_id
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query, ctx.guild.id)
-
-        value = '\n'.join(f'{lookup[index]}: <@!{author_id}> ({uses} 次使用)'
-                          for (index, (author_id, uses)) in enumerate(records)) or '没有机器人使用者。'
-
+        value = '\n'.join(f'{lookup[index]}: <@!{r["author_id"]}> ({r["uses"]} 次使用)'
+                          for (index, r) in enumerate(sections['author_today'])) or '没有机器人使用者。'
         embed.add_field(name='今天的最强命令使用者: \n' + value)
         await ctx.reply(embed=embed)
 
@@ -362,44 +595,30 @@ class Stats(commands.Cog):
         embed = qq.Embed(title='Command Stats', colour=member.colour)
         embed.set_author(name=str(member), icon_url=member.display_avatar.url)
 
-        # total command uses
-        query = "SELECT COUNT(*), MIN(used) FROM commands WHERE guild_id=$1 AND author_id=$2;"
-        count = await ctx.db.fetchrow(query, ctx.guild.id, member.id)
-
-        embed.description = f'{count[0]} commands used.'
-
-        query = """SELECT command,
-                          COUNT(*) as "uses"
-                   FROM commands
-                   WHERE guild_id=$1 AND author_id=$2
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
+        query = """WITH base AS (
+                       SELECT command, used, count FROM commands WHERE guild_id=$1 AND author_id=$2
+                   )
+                   (SELECT 'total' AS section, NULL::text AS command, COALESCE(SUM(count), 0) AS uses
+                    FROM base)
+                   UNION ALL
+                   (SELECT 'command', command, SUM(count) AS uses
+                    FROM base GROUP BY command ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'command_today', command, SUM(count) AS uses
+                    FROM base WHERE used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
+                    GROUP BY command ORDER BY uses DESC LIMIT 5);
                 """
+        sections = partition_sections(await ctx.db.fetch(query, ctx.guild.id, member.id))
 
-        records = await ctx.db.fetch(query, ctx.guild.id, member.id)
-
-        value = '\n'.join(f'{lookup[index]}: {command} ({uses} uses)'
-                          for (index, (command, uses)) in enumerate(records)) or 'No Commands'
+        # total command uses
+        embed.description = f'{sections["total"][0]["uses"]} commands used.'
 
+        value = '\n'.join(f'{lookup[index]}: {r["command"]} ({r["uses"]} uses)'
+                          for (index, r) in enumerate(sections['command'])) or 'No Commands'
         embed.add_field(name='Most Used Commands', value=value, inline=False)
 
-        query = """SELECT command,
-                          COUNT(*) as "uses"
-                   FROM commands
-                   WHERE guild_id=$1
-                   AND author_id=$2
-                   AND used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query, ctx.guild.id, member.id)
-
-        value = '\n'.join(f'{lookup[index]}: {command} ({uses} uses)'
-                          for (index, (command, uses)) in enumerate(records)) or 'No Commands'
-
+        value = '\n'.join(f'{lookup[index]}: {r["command"]} ({r["uses"]} uses)'
+                          for (index, r) in enumerate(sections['command_today'])) or 'No Commands'
         embed.add_field(name='Most Used Commands Today', value=value, inline=False)
         await ctx.reply(embed=embed)
 
@@ -418,67 +637,24 @@ class Stats(commands.Cog):
     async def stats_global(self, ctx):
         """全局所有时间命令统计。"""
 
-        query = "SELECT COUNT(*) FROM commands;"
-        total = await ctx.db.fetchrow(query)
-
-        e = qq.Embed(title='Command Stats', colour=qq.Colour.blurple())
-        e.description = f'{total[0]} commands used.'
-
-        lookup = (
-            '\N{FIRST PLACE MEDAL}',
-            '\N{SECOND PLACE MEDAL}',
-            '\N{THIRD PLACE MEDAL}',
-            '\N{SPORTS MEDAL}',
-            '\N{SPORTS MEDAL}'
-        )
-
-        query = """SELECT command, COUNT(*) AS "uses"
-                   FROM commands
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
+        query = """(SELECT 'total' AS section, NULL::text AS command, NULL::numeric AS guild_id,
+                           NULL::numeric AS author_id, COALESCE(SUM(count), 0) AS uses
+                    FROM commands)
+                   UNION ALL
+                   (SELECT 'command', command, NULL, NULL, SUM(count) AS uses
+                    FROM commands GROUP BY command ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'guild', NULL, guild_id, NULL, SUM(count) AS uses
+                    FROM commands GROUP BY guild_id ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'author', NULL, NULL, author_id, SUM(count) AS uses
+                    FROM commands GROUP BY author_id ORDER BY uses DESC LIMIT 5);
                 """
+        sections = partition_sections(await ctx.db.fetch(query))
 
-        records = await ctx.db.fetch(query)
-        value = '\n'.join(
-            f'{lookup[index]}: {command} ({uses} uses)' for (index, (command, uses)) in enumerate(records))
-        e.add_field(name='Top Commands', value=value, inline=False)
-
-        query = """SELECT guild_id, COUNT(*) AS "uses"
-                   FROM commands
-                   GROUP BY guild_id
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query)
-        value = []
-        for (index, (guild_id, uses)) in enumerate(records):
-            if guild_id is None:
-                guild = 'Private Message'
-            else:
-                guild = self.censor_object(self.bot.get_guild(guild_id) or f'<Unknown {guild_id}>')
-
-            emoji = lookup[index]
-            value.append(f'{emoji}: {guild} ({uses} uses)')
-
-        e.add_field(name='Top Guilds', value='\n'.join(value), inline=False)
-
-        query = """SELECT author_id, COUNT(*) AS "uses"
-                   FROM commands
-                   GROUP BY author_id
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query)
-        value = []
-        for (index, (author_id, uses)) in enumerate(records):
-            user = self.censor_object(self.bot.get_user(author_id) or f'<Unknown {author_id}>')
-            emoji = lookup[index]
-            value.append(f'{emoji}: {user} ({uses} uses)')
-
-        e.add_field(name='Top Users', value='\n'.join(value), inline=False)
+        e = qq.Embed(title='Command Stats', colour=qq.Colour.blurple())
+        e.description = f'{sections["total"][0]["uses"]} commands used.'
+        self._add_top_fields(e, sections)
         await ctx.reply(embed=e)
 
     @stats.command(name='today')
@@ -486,15 +662,29 @@ class Stats(commands.Cog):
     async def stats_today(self, ctx):
         """当天的全局命令统计。"""
 
-        query = "SELECT failed, " \
-                "COUNT(*) FROM commands " \
-                "WHERE used > (CURRENT_TIMESTAMP - INTERVAL '1 day') " \
-                "GROUP BY failed;"
-        total = await ctx.db.fetch(query)
+        query = """WITH today AS (
+                       SELECT * FROM commands WHERE used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
+                   )
+                   (SELECT 'total' AS section, failed, NULL::text AS command, NULL::numeric AS guild_id,
+                           NULL::numeric AS author_id, SUM(count) AS uses
+                    FROM today GROUP BY failed)
+                   UNION ALL
+                   (SELECT 'command', NULL, command, NULL, NULL, SUM(count) AS uses
+                    FROM today GROUP BY command ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'guild', NULL, NULL, guild_id, NULL, SUM(count) AS uses
+                    FROM today GROUP BY guild_id ORDER BY uses DESC LIMIT 5)
+                   UNION ALL
+                   (SELECT 'author', NULL, NULL, NULL, author_id, SUM(count) AS uses
+                    FROM today GROUP BY author_id ORDER BY uses DESC LIMIT 5);
+                """
+        sections = partition_sections(await ctx.db.fetch(query))
+
         failed = 0
         success = 0
         question = 0
-        for state, count in total:
+        for record in sections['total']:
+            state, count = record['failed'], record['uses']
             if state is False:
                 success += count
             elif state is True:
@@ -505,7 +695,10 @@ class Stats(commands.Cog):
         e = qq.Embed(title='Last 24 Hour Command Stats', colour=qq.Colour.blurple())
         e.description = f'{failed + success + question} commands used today. ' \
                         f'({success} succeeded, {failed} failed, {question} unknown)'
+        self._add_top_fields(e, sections)
+        await ctx.reply(embed=e)
 
+    def _add_top_fields(self, e, sections):
         lookup = (
             '\N{FIRST PLACE MEDAL}',
             '\N{SECOND PLACE MEDAL}',
@@ -514,56 +707,31 @@ class Stats(commands.Cog):
             '\N{SPORTS MEDAL}'
         )
 
-        query = """SELECT command, COUNT(*) AS "uses"
-                   FROM commands
-                   WHERE used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
-                   GROUP BY command
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query)
         value = '\n'.join(
-            f'{lookup[index]}: {command} ({uses} uses)' for (index, (command, uses)) in enumerate(records))
+            f'{lookup[index]}: {r["command"]} ({r["uses"]} uses)' for (index, r) in enumerate(sections['command']))
         e.add_field(name='Top Commands', value=value, inline=False)
 
-        query = """SELECT guild_id, COUNT(*) AS "uses"
-                   FROM commands
-                   WHERE used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
-                   GROUP BY guild_id
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query)
         value = []
-        for (index, (guild_id, uses)) in enumerate(records):
+        for (index, r) in enumerate(sections['guild']):
+            guild_id = r['guild_id']
             if guild_id is None:
                 guild = 'Private Message'
             else:
                 guild = self.censor_object(self.bot.get_guild(guild_id) or f'<Unknown {guild_id}>')
+
             emoji = lookup[index]
-            value.append(f'{emoji}: {guild} ({uses} uses)')
+            value.append(f'{emoji}: {guild} ({r["uses"]} uses)')
 
         e.add_field(name='Top Guilds', value='\n'.join(value), inline=False)
 
-        query = """SELECT author_id, COUNT(*) AS "uses"
-                   FROM commands
-                   WHERE used > (CURRENT_TIMESTAMP - INTERVAL '1 day')
-                   GROUP BY author_id
-                   ORDER BY "uses" DESC
-                   LIMIT 5;
-                """
-
-        records = await ctx.db.fetch(query)
         value = []
-        for (index, (author_id, uses)) in enumerate(records):
+        for (index, r) in enumerate(sections['author']):
+            author_id = r['author_id']
             user = self.censor_object(self.bot.get_user(author_id) or f'<Unknown {author_id}>')
             emoji = lookup[index]
-            value.append(f'{emoji}: {user} ({uses} uses)')
+            value.append(f'{emoji}: {user} ({r["uses"]} uses)')
 
         e.add_field(name='Top Users', value='\n'.join(value), inline=False)
-        await ctx.reply(embed=e)
 
     async def send_guild_stats(self, e, guild):
         e.add_field(name='Name: ' + guild.name)
@@ -571,7 +739,7 @@ class Stats(commands.Cog):
         e.add_field(name='Shard ID: ' + guild.shard_id or 'N/A')
         e.add_field(name='Owner: ' + f'{guild.owner} (ID: {guild.owner_id})')
 
-        bots = sum(m.bot for m in guild.members)
+        bots = self.get_bot_count(guild)
         total = guild.member_count
         e.add_field(name='Members: ' + str(total))
         e.add_field(name='Bots: ' + f'{bots} ({bots / total:.2%})')
@@ -618,10 +786,15 @@ class Stats(commands.Cog):
             fmt = f'{fmt}\nGuild: {ctx.guild} (ID: {ctx.guild.id})'
 
         e.add_field(name='Location: ' + fmt, inline=False)
-        e.add_field(name='Content: ' + textwrap.shorten(ctx.message.content, width=512))
-
-        exc = ''.join(traceback.format_exception(type(error), error, error.__traceback__, chain=False))
-        log.error(exc)
+        content = ctx.message.content
+        if len(content) > 512:
+            content = textwrap.shorten(content, width=512)
+        e.add_field(name='Content: ' + content)
+
+        # straight into one buffer instead of a list of lines joined afterwards
+        buf = io.StringIO()
+        traceback.print_exception(type(error), error, error.__traceback__, chain=False, file=buf)
+        log.error(buf.getvalue())
         e.timestamp = qq.utils.utcnow()
         await ctx.reply(embed=e)
 
@@ -630,7 +803,7 @@ class Stats(commands.Cog):
         #     return
         self._gateway_queue.put_nowait(record)
 
-    async def notify_gateway_status(self, record):
+    def format_gateway_record(self, record):
         attributes = {
             'INFO': '\N{INFORMATION SOURCE}',
             'WARNING': '\N{WARNING SIGN}'
@@ -638,7 +811,21 @@ class Stats(commands.Cog):
 
         emoji = attributes.get(record.levelname, '\N{CROSS MARK}')
         dt = datetime.datetime.utcfromtimestamp(record.created)
-        msg = textwrap.shorten(f'{emoji} [{time.format_dt(dt)}] `{record.message}`', width=1990)
+        return f'{emoji} [{time.format_dt(dt)}] `{record.message}`'
+
+    async def notify_gateway_status(self, records):
+        msg = '\n'.join(map(self.format_gateway_record, records))
+        # textwrap.shorten would fold the newlines between records
+        if len(msg) > 1990:
+            msg = msg[:1986] + ' ...'
+
+        channel = self.bot.get_channel(LOGGING_CHANNEL)
+        if channel is None:
+            return
+        try:
+            await channel.send(msg)
+        except qq.HTTPException:
+            pass
 
     @commands.command(hidden=True)
     @commands.is_owner()
@@ -667,14 +854,16 @@ class Stats(commands.Cog):
         ]
 
         questionable_connections = 0
-        connection_value = []
-        for index, holder in enumerate(pool._holders, start=1):
+        holders = pool._holders
+        # one line per holder, the size is known up front
+        connection_value = [None] * len(holders)
+        for index, holder in enumerate(holders):
             generation = holder._generation
             in_use = holder._in_use is not None
             is_closed = holder._con is None or holder._con.is_closed()
             display = f'gen={holder._generation} in_use={in_use} closed={is_closed}'
             questionable_connections += any((in_use, generation != current_generation))
-            connection_value.append(f'<Holder i={index} {display}>')
+            connection_value[index] = f'<Holder i={index + 1} {display}>'
 
         joined_value = '\n'.join(connection_value)
         description.append('Connections: \n' + f'```py\n{joined_value}\n```')
@@ -701,17 +890,23 @@ class Stats(commands.Cog):
 
         all_tasks = task_retriever(loop=self.bot.loop)
 
-        event_tasks = [
-            t for t in all_tasks
-            if 'Client._run_event' in repr(t) and not t.done()
-        ]
-
         cogs_directory = os.path.dirname(__file__)
         tasks_directory = os.path.join('qq', 'ext', 'tasks', '__init__.py')
-        inner_tasks = [
-            t for t in all_tasks
-            if cogs_directory in repr(t) or tasks_directory in repr(t)
-        ]
+        event_tasks = []
+        inner_tasks = []
+        # look at the coroutine directly, repr() formats the whole task every time
+        for t in all_tasks:
+            coro = t.get_coro()
+            code = getattr(coro, 'cr_code', None)
+            if code is None:
+                continue
+
+            if not t.done() and getattr(coro, '__qualname__', '') == 'Client._run_event':
+                event_tasks.append(t)
+
+            filename = code.co_filename
+            if cogs_directory in filename or tasks_directory in filename:
+                inner_tasks.append(t)
 
         bad_inner_tasks = ", ".join(hex(id(t)) for t in inner_tasks if t.done() and t._exception is not None)
         total_warnings += bool(bad_inner_tasks)
@@ -719,10 +914,9 @@ class Stats(commands.Cog):
         description.append('Events Waiting: \n' + f'Total: {len(event_tasks)}')
 
         command_waiters = len(self._data_batch)
-        is_locked = self._batch_lock.locked()
-        description.append(f'Commands Waiting: {command_waiters}, Batch Locked: {is_locked}')
+        description.append(f'Commands Waiting: {command_waiters}')
 
-        memory_usage = self.process.memory_full_info().uss / 1024 ** 2
+        memory_usage = self.process.memory_info().rss / 1024 ** 2
         cpu_usage = self.process.cpu_percent() / psutil.cpu_count()
         description.append('Process: \n' + f'{memory_usage:.2f} MiB\n{cpu_usage:.2f}% CPU')
 
@@ -816,7 +1010,7 @@ class Stats(commands.Cog):
     @commands.is_owner()
     async def debug_task(self, ctx, memory_id: hex_value):
         """Debug a task by a memory location."""
-        task = object_at(memory_id)
+        task = object_at(memory_id, loop=self.bot.loop)
         if task is None or not isinstance(task, asyncio.Task):
             return await ctx.reply(f'Could not find Task object at {hex(memory_id)}.')
 
@@ -848,134 +1042,101 @@ class Stats(commands.Cog):
         table.add_rows(list(r.values()) for r in records)
         render = table.render()
 
-        fmt = f'```\n{render}\n```'
-        if len(fmt) > 2000:
-            fp = io.BytesIO(fmt.encode('utf-8'))
+        # the fences add 8 characters, only build the message string if it's going to fit
+        if len(render) + 8 > 2000:
+            fp = io.BytesIO(b'```\n' + render.encode('utf-8') + b'\n```')
             await ctx.reply('Too many results...', file=qq.File(fp, 'results.txt'))
         else:
-            await ctx.reply(fmt)
+            await ctx.reply(f'```\n{render}\n```')
+
+    async def fetch_history(self, ctx, key, query, *args):
+        # the summaries scan days worth of rows, re-running them straight away is pointless
+        now = self.bot.loop.time()
+        entry = self._history_cache.get(key)
+        if entry is not None and now - entry[0] < 60:
+            return entry[1]
+
+        records = await ctx.db.fetch(query, *args)
+        # drop whatever has gone stale so old keys don't pile up
+        cache = self._history_cache
+        for stale in [k for k, (cached_at, _) in cache.items() if now - cached_at >= 60]:
+            del cache[stale]
+        cache[key] = (now, records)
+        return records
 
     @commands.group(hidden=True, invoke_without_command=True)
     @commands.is_owner()
     async def command_history(self, ctx):
         """Command history."""
-        query = """SELECT
-                        CASE failed
-                            WHEN TRUE THEN command || ' [!]'
-                            ELSE command
-                        END AS "command",
-                        to_char(used, 'Mon DD HH12:MI:SS AM') AS "invoked",
-                        author_id,
-                        guild_id
-                   FROM commands
-                   ORDER BY used DESC
-                   LIMIT 15;
-                """
-        await self.tabulate_query(ctx, query)
+        await self.tabulate_query(ctx, _HISTORY_RECENT_QUERY)
 
     @command_history.command(name='for')
     @commands.is_owner()
     async def command_history_for(self, ctx, days: typing.Optional[int] = 7, *, command: str):
         """Command history for a command."""
 
-        query = """SELECT *, t.success + t.failed AS "total"
-                   FROM (
-                       SELECT guild_id,
-                              SUM(CASE WHEN failed THEN 0 ELSE 1 END) AS "success",
-                              SUM(CASE WHEN failed THEN 1 ELSE 0 END) AS "failed"
-                       FROM commands
-                       WHERE command=$1
-                       AND used > (CURRENT_TIMESTAMP - $2::interval)
-                       GROUP BY guild_id
-                   ) AS t
-                   ORDER BY "total" DESC
-                   LIMIT 30;
-                """
-
-        await self.tabulate_query(ctx, query, command, datetime.timedelta(days=days))
+        await self.tabulate_query(ctx, _HISTORY_FOR_QUERY, command, datetime.timedelta(days=days))
 
     @command_history.command(name='guild', aliases=['server'])
     @commands.is_owner()
     async def command_history_guild(self, ctx, guild_id: int):
         """Command history for a guild."""
 
-        query = """SELECT
-                        CASE failed
-                            WHEN TRUE THEN command || ' [!]'
-                            ELSE command
-                        END AS "command",
-                        channel_id,
-                        author_id,
-                        used
-                   FROM commands
-                   WHERE guild_id=$1
-                   ORDER BY used DESC
-                   LIMIT 15;
-                """
-        await self.tabulate_query(ctx, query, guild_id)
+        await self.tabulate_query(ctx, _HISTORY_GUILD_QUERY, guild_id)
 
     @command_history.command(name='user', aliases=['member'])
     @commands.is_owner()
     async def command_history_user(self, ctx, user_id: int):
         """Command history for a user."""
 
-        query = """SELECT
-                        CASE failed
-                            WHEN TRUE THEN command || ' [!]'
-                            ELSE command
-                        END AS "command",
-                        guild_id,
-                        used
-                   FROM commands
-                   WHERE author_id=$1
-                   ORDER BY used DESC
-                   LIMIT 20;
-                """
-        await self.tabulate_query(ctx, query, user_id)
+        await self.tabulate_query(ctx, _HISTORY_USER_QUERY, user_id)
 
     @command_history.command(name='log')
     @commands.is_owner()
     async def command_history_log(self, ctx, days=7):
         """Command history log for the last N days."""
 
-        query = """SELECT command, COUNT(*)
-                   FROM commands
-                   WHERE used > (CURRENT_TIMESTAMP - $1::interval)
-                   GROUP BY command
-                   ORDER BY 2 DESC
-                """
-
-        all_commands = {
-            c.qualified_name: 0
-            for c in self.bot.walk_commands()
-        }
+        records = await self.fetch_history(ctx, ('log', days), _HISTORY_LOG_QUERY, datetime.timedelta(days=days))
+        # every registered command starts at zero so the unused ones show up too
+        all_commands = dict.fromkeys(self.get_command_map(), 0)
+        all_commands.update((name, uses) for name, uses in records if name in all_commands)
 
-        records = await ctx.db.fetch(query, datetime.timedelta(days=days))
-        for name, uses in records:
-            if name in all_commands:
-                all_commands[name] = uses
+        # split out the unused commands in one pass so only the used ones need ranking
+        used, unused_names = [], []
+        for name, uses in all_commands.items():
+            if uses:
+                used.append((name, uses))
+            else:
+                unused_names.append(name)
 
-        as_data = sorted(all_commands.items(), key=lambda t: t[1], reverse=True)
+        key = operator.itemgetter(1)
+        used.sort(key=key, reverse=True)
         table = formats.TabularData()
         table.set_columns(['Command', 'Uses'])
-        table.add_rows(tup for tup in as_data)
+        table.add_rows(used)
+        table.add_rows((name, 0) for name in unused_names)
         render = table.render()
 
         embed = qq.Embed(title='Summary', colour=qq.Colour.green())
         embed.set_footer(text='Since').timestamp = qq.utils.utcnow() - datetime.timedelta(days=days)
 
-        top_ten = '\n'.join(f'{command}: {uses}' for command, uses in records[:10])
-        bottom_ten = '\n'.join(f'{command}: {uses}' for command, uses in records[-10:])
+        top_ten = '\n'.join(f'{command}: {uses}' for command, uses in used[:10])
+        bottom_ten = '\n'.join(f'{command}: {uses}' for command, uses in used[-10:])
         embed.add_field(name='Top 10', value=top_ten)
         embed.add_field(name='Bottom 10', value=bottom_ten)
 
-        unused = ', '.join(name for name, uses in as_data if uses == 0)
+        unused = ', '.join(unused_names)
         if len(unused) > 1024:
             unused = 'Way too many...'
 
         embed.add_field(name='Unused', value=unused, inline=False)
 
-        await ctx.reply(embed=embed, file=qq.File(io.BytesIO(render.encode()), filename='full_results.txt'))
+        # small tables fit in the message itself, only upload a file when they don't
+        if len(render) + 8 > 2000:
+            fp = io.BytesIO(render.encode('utf-8'))
+            await ctx.reply(embed=embed, file=qq.File(fp, filename='full_results.txt'))
+        else:
+            await ctx.reply(f'```\n{render}\n```', embed=embed)
 
     @command_history.command(name='cog')
     @commands.is_owner()
@@ -988,63 +1149,20 @@ class Stats(commands.Cog):
             if cog is None:
                 return await ctx.reply(f'Unknown cog: {cog}')
 
-            query = """SELECT *, t.success + t.failed AS "total"
-                       FROM (
-                           SELECT command,
-                                  SUM(CASE WHEN failed THEN 0 ELSE 1 END) AS "success",
-                                  SUM(CASE WHEN failed THEN 1 ELSE 0 END) AS "failed"
-                           FROM commands
-                           WHERE command = any($1::text[])
-                           AND used > (CURRENT_TIMESTAMP - $2::interval)
-                           GROUP BY command
-                       ) AS t
-                       ORDER BY "total" DESC
-                       LIMIT 30;
-                    """
-            return await self.tabulate_query(ctx, query, [c.qualified_name for c in cog.walk_commands()], interval)
-
-        # A more manual query with a manual grouper.
-        query = """SELECT *, t.success + t.failed AS "total"
-                   FROM (
-                       SELECT command,
-                              SUM(CASE WHEN failed THEN 0 ELSE 1 END) AS "success",
-                              SUM(CASE WHEN failed THEN 1 ELSE 0 END) AS "failed"
-                       FROM commands
-                       WHERE used > (CURRENT_TIMESTAMP - $1::interval)
-                       GROUP BY command
-                   ) AS t;
-                """
+            names = [name for name, command in self.get_command_map().items() if command.cog is cog]
+            return await self.tabulate_query(ctx, _HISTORY_COG_QUERY, names, interval)
 
-        class Count:
-            __slots__ = ('success', 'failed', 'total')
-
-            def __init__(self):
-                self.success = 0
-                self.failed = 0
-                self.total = 0
-
-            def add(self, record):
-                self.success += record['success']
-                self.failed += record['failed']
-                self.total += record['total']
-
-        data = defaultdict(Count)
-        records = await ctx.db.fetch(query, interval)
-        for record in records:
-            command = self.bot.get_command(record['command'])
-            if command is None or command.cog is None:
-                data['No Cog'].add(record)
-            else:
-                data[command.cog.qualified_name].add(record)
+        # Map every command to its cog and let PostgreSQL do the grouping,
+        # anything that isn't a registered command falls into "No Cog".
+        command_map = self.get_command_map()
+        names = [name for name, command in command_map.items() if command.cog is not None]
+        cogs = [command_map[name].cog.qualified_name for name in names]
+        key = ('cog', days, self._cmd_map_version)
+        data = await self.fetch_history(ctx, key, _HISTORY_COGS_QUERY, interval, names, cogs)
 
         table = formats.TabularData()
         table.set_columns(['Cog', 'Success', 'Failed', 'Total'])
-        data = sorted([
-            (cog, e.success, e.failed, e.total)
-            for cog, e in data.items()
-        ], key=lambda t: t[-1], reverse=True)
-
-        table.add_rows(data)
+        table.add_rows(list(r.values()) for r in data)
         render = table.render()
         await ctx.safe_send(f'```\n{render}\n```')
 
@@ -1058,6 +1176,11 @@ async def on_error(self, event, *args, **kwargs):
     if isinstance(exc, commands.CommandInvokeError):
         return
 
+    # without somewhere to send the embed there's no point formatting it
+    hook = getattr(self.get_cog('Stats'), 'webhook', None)
+    if hook is None:
+        return await old_on_error(self, event, *args, **kwargs)
+
     e = qq.Embed(title='Event Error', colour=0xa32952)
     e.add_field(name='Event', value=event)
     trace = "".join(traceback.format_exception(exc_type, exc, tb))
@@ -1065,11 +1188,9 @@ async def on_error(self, event, *args, **kwargs):
     e.timestamp = qq.utils.utcnow()
 
     args_str = ['```py']
-    for index, arg in enumerate(args):
-        args_str.append(f'[{index}]: {arg!r}')
+    args_str.extend(f'[{index}]: {arg!r}' for index, arg in enumerate(itertools.islice(args, 20)))
     args_str.append('```')
     e.add_field(name='Args', value='\n'.join(args_str), inline=False)
-    hook = self.get_cog('Stats').webhook
     try:
         await hook.send(embed=e)
     except:
@@ -3,6 +3,11 @@ import json
 import os
 import uuid
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def _create_encoder(cls):
     def _default(self, o):
@@ -31,15 +36,28 @@ class Config:
 
         self.loop = options.pop('loop', asyncio.get_event_loop())
         self.lock = asyncio.Lock()
+
+        # edits are written to disk at most once per this many seconds
+        self.save_delay = options.pop('save_delay', 0.5)
+        self._save_task = None
         if options.pop('load_later', False):
             self.loop.create_task(self.load())
         else:
             self.load_from_file()
 
+    @property
+    def _use_orjson(self):
+        # orjson has no equivalent to the custom object hooks and encoders
+        return orjson is not None and self.object_hook is None and self.encoder is None
+
     def load_from_file(self):
         try:
-            with open(self.name, 'r') as f:
-                self._db = json.load(f, object_hook=self.object_hook)
+            if self._use_orjson:
+                with open(self.name, 'rb') as f:
+                    self._db = orjson.loads(f.read())
+            else:
+                with open(self.name, 'r') as f:
+                    self._db = json.load(f, object_hook=self.object_hook)
         except FileNotFoundError:
             self._db = {}
 
@@ -47,17 +65,43 @@ class Config:
         async with self.lock:
             await self.loop.run_in_executor(None, self.load_from_file)
 
-    def _dump(self):
+    def _dump(self, data):
+        if self._use_orjson:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(data, ensure_ascii=True, cls=self.encoder, separators=(',', ':')).encode('utf-8')
+
+    def _write(self, payload):
         temp = '%s-%s.tmp' % (uuid.uuid4(), self.name)
-        with open(temp, 'w', encoding='utf-8') as tmp:
-            json.dump(self._db.copy(), tmp, ensure_ascii=True, cls=self.encoder, separators=(',', ':'))
+        with open(temp, 'wb') as tmp:
+            tmp.write(payload)
 
         # atomically move the file
         os.replace(temp, self.name)
 
     async def save(self):
         async with self.lock:
-            await self.loop.run_in_executor(None, self._dump)
+            # the values are live objects the loop keeps editing, so serialize
+            # here and only hand the finished bytes to the executor thread
+            payload = self._dump(self._db)
+            await self.loop.run_in_executor(None, self._write, payload)
+
+    async def _delayed_save(self):
+        await asyncio.sleep(self.save_delay)
+        # anything edited from here on needs another save
+        self._save_task = None
+        await self.save()
+
+    def _schedule_save(self):
+        if self._save_task is None:
+            self._save_task = self.loop.create_task(self._delayed_save())
+
+    async def flush(self):
+        """Writes any pending edits to disk right away."""
+        task = self._save_task
+        if task is not None:
+            self._save_task = None
+            task.cancel()
+            await self.save()
 
     def get(self, key, *args):
         """Retrieves a config entry."""
@@ -66,12 +110,12 @@ class Config:
     async def put(self, key, value, *args):
         """Edits a config entry."""
         self._db[str(key)] = value
-        await self.save()
+        self._schedule_save()
 
     async def remove(self, key):
         """Removes a config entry."""
         del self._db[str(key)]
-        await self.save()
+        self._schedule_save()
 
     def __contains__(self, item):
         return str(item) in self._db
@@ -23,6 +23,11 @@ from pathlib import Path
 
 import asyncpg
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
 
 
@@ -517,11 +522,19 @@ class Table(metaclass=TableMeta):
             The arguments to forward to asyncpg.create_pool.
         """
 
-        def _encode_jsonb(value):
-            return json.dumps(value)
+        # codecs run on the event loop for every jsonb value, so use the
+        # faster encoder when it's around
+        if orjson is not None:
+            def _encode_jsonb(value):
+                return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+            _decode_jsonb = orjson.loads
+        else:
+            def _encode_jsonb(value):
+                return json.dumps(value)
 
-        def _decode_jsonb(value):
-            return json.loads(value)
+            def _decode_jsonb(value):
+                return json.loads(value)
 
         old_init = kwargs.pop('init', None)
 
@@ -2,22 +2,61 @@ import asyncio
 import json
 import logging
 from io import BytesIO
+from typing import BinaryIO, Optional, Union
 
 import aiohttp
 from aiohttp import FormData
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# shared between uploads so the connection to the image host gets reused
+_session: Optional[aiohttp.ClientSession] = None
+_session_lock: Optional[asyncio.Lock] = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session, _session_lock
+    if _session_lock is None:
+        _session_lock = asyncio.Lock()
+
+    async with _session_lock:
+        if _session is None or _session.closed:
+            connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, enable_cleanup_closed=True)
+            _session = aiohttp.ClientSession(connector=connector)
+        return _session
+
 
-async def upload(image: BytesIO) -> str:
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def upload(image: Union[BinaryIO, BytesIO]) -> str:
     form_data = FormData()
     form_data.add_field('fileupload', image, filename='test.png')
-    async with aiohttp.ClientSession() as session:
-        async with session.post('http://pic.qingchengkg.cn/api/upload/', data=form_data) as response:
-            data = json.loads(await response.text())
-            logger.debug('Image upload status %d with data %s', response.status, data)
-            return data['url']
+    session = await _get_session()
+    async with session.post('http://pic.qingchengkg.cn/api/upload/', data=form_data) as response:
+        # the host doesn't always send a json content type
+        data = await response.json(loads=orjson.loads if orjson is not None else json.loads, content_type=None)
+        logger.debug('Image upload status %d with data %s', response.status, data)
+        return data['url']
+
+
+async def _main():
+    try:
+        # aiohttp streams straight from the file object
+        with open('./test.png', 'rb') as fp:
+            await upload(fp)
+    finally:
+        await close()
 
 
 if __name__ == '__main__':
-    asyncio.run(upload(BytesIO(open('./test.png', 'rb').read())))
+    asyncio.run(_main())
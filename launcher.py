@@ -1,17 +1,26 @@
 import asyncio
 import contextlib
+import copy
 import importlib
+import json
 import logging
+import os
+import queue
 import sys
 import traceback
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import click
 import colorlog
 
 import config
 from bot import initial_extensions, BeepBoopFox
-from cogs.utils.db import Table
+from cogs.utils.db import ForeignKey, Table
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 try:
     import uvloop
@@ -31,8 +40,75 @@ class RemoveNoise(logging.Filter):
         return True
 
 
+class JSONFormatter(logging.Formatter):
+    """Formats every record as a single JSON line."""
+
+    def format(self, record):
+        data = {
+            'ts': record.created,
+            'lvl': record.levelname,
+            'name': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        if orjson is not None:
+            return orjson.dumps(data).decode('utf-8')
+        return json.dumps(data, ensure_ascii=False)
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """A rotating file handler that only flushes its buffer for warnings and above.
+
+    Everything else sits in a large write buffer until it fills up, the file
+    rolls over or the handler is closed.
+    """
+
+    buffer_size = 1024 * 1024  # 1 MiB
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, encoding=self.encoding, buffering=self.buffer_size)
+        self._bytes_written = os.path.getsize(self.baseFilename)
+        return stream
+
+    def shouldRollover(self, record):
+        # the base class asks the stream where it is with tell(), which flushes
+        # the buffer every time, so keep count of the written bytes instead
+        if self.stream is None:
+            self.stream = self._open()
+
+        self._pending_bytes = len(f'{self.format(record)}{self.terminator}'.encode(self.encoding or 'utf-8'))
+        return 0 < self.maxBytes <= self._bytes_written + self._pending_bytes
+
+    def emit(self, record):
+        self._should_flush = record.levelno >= logging.WARNING
+        self._pending_bytes = 0
+        super().emit(record)
+        self._bytes_written += self._pending_bytes
+
+    def flush(self):
+        if getattr(self, '_should_flush', True):
+            super().flush()
+
+
+class LocalQueueHandler(QueueHandler):
+    """A queue handler for a listener in the same process.
+
+    The stock handler folds the traceback into the message so the record can
+    be pickled. That isn't needed here, and keeping ``exc_info`` lets the file
+    handler store tracebacks in their own field.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 @contextlib.contextmanager
 def setup_logging():
+    listener = None
     try:
         # __enter__
         max_bytes = 32 * 1024 * 1024  # 32 MiB
@@ -42,27 +118,32 @@ def setup_logging():
 
         log = logging.getLogger()
         log.setLevel(logging.INFO)
-        handler = RotatingFileHandler(filename='bb_fox.log', encoding='utf-8', mode='w', maxBytes=max_bytes,
-                                      backupCount=5)
-        dt_fmt = '%Y-%m-%d %H:%M:%S'
-        fmt = logging.Formatter('[{asctime}] [{levelname:<7}] {name}: {message}', dt_fmt, style='{')
-        handler.setFormatter(fmt)
-        log.addHandler(handler)
+        handler = BufferedRotatingFileHandler(filename='bb_fox.log', encoding='utf-8', mode='w',
+                                              maxBytes=max_bytes, backupCount=5)
+        handler.setFormatter(JSONFormatter())
 
-        log = logging.getLogger()
-        handler = colorlog.StreamHandler()
-        handler.setFormatter(
+        stream_handler = colorlog.StreamHandler()
+        stream_handler.setFormatter(
             colorlog.ColoredFormatter(
                 "%(log_color)s[%(asctime)s] [%(name)-15s] [%(levelname)-7s]: %(message)s (%(filename)s:%(lineno)d)",
                 "%Y-%m-%d %H:%M:%S")
         )
 
-        log.setLevel(logging.INFO)
-        log.addHandler(handler)
+        # the actual writes happen on the listener's thread so that logging
+        # never blocks the event loop on disk or terminal I/O
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, handler, stream_handler, respect_handler_level=True)
+        log.addHandler(LocalQueueHandler(log_queue))
+        listener.start()
 
         yield
     finally:
         # __exit__
+        if listener is not None:
+            listener.stop()
+            for hdlr in listener.handlers:
+                hdlr.close()
+
         handlers = log.handlers[:]
         for hdlr in handlers:
             hdlr.close()
@@ -74,8 +155,10 @@ def run_bot():
     log = logging.getLogger()
     kwargs = {
         'command_timeout': 60,
-        'max_size': 20,
-        'min_size': 20,
+        'max_size': 50,
+        'min_size': 10,
+        'max_inactive_connection_lifetime': 300,
+        'statement_cache_size': 1024,
     }
     try:
         pool = loop.run_until_complete(Table.create_pool(config.postgresql, **kwargs))
@@ -89,6 +172,20 @@ def run_bot():
     bot.run()
 
 
+def run_cli(coro):
+    """Runs a database command in a single fresh event loop, closing the pool afterwards."""
+
+    async def runner():
+        try:
+            return await coro
+        finally:
+            pool = getattr(Table, '_pool', None)
+            if pool is not None:
+                await pool.close()
+
+    return asyncio.run(runner())
+
+
 @click.group(invoke_without_command=True, options_metavar='[options]')
 @click.pass_context
 def main(ctx):
@@ -110,28 +207,40 @@ def db():
 def init(cogs, quiet):
     """This manages the migrations and database creation system for you."""
 
-    run = asyncio.get_event_loop().run_until_complete
-    try:
-        run(Table.create_pool(config.postgresql))
-    except Exception:
-        click.echo(f'无法创建 PostgreSQL 连接池。\n{traceback.format_exc()}', err=True)
-        return
-
     if not cogs:
         cogs = initial_extensions
     else:
         cogs = [f'cogs.{e}' if not e.startswith('cogs.') else e for e in cogs]
 
-    for ext in cogs:
-        try:
-            importlib.import_module(ext)
-        except Exception:
-            click.echo(f'无法加载 {ext}.\n{traceback.format_exc()}', err=True)
-            return
+    run_cli(create_tables(cogs, quiet))
+
+
+async def create_tables(cogs, quiet):
+    try:
+        await Table.create_pool(config.postgresql)
+    except Exception:
+        click.echo(f'无法创建 PostgreSQL 连接池。\n{traceback.format_exc()}', err=True)
+        return
+
+    # the cogs don't depend on each other so they can be imported side by side
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(None, importlib.import_module, ext) for ext in cogs),
+        return_exceptions=True
+    )
+    failed = False
+    for ext, result in zip(cogs, results):
+        if isinstance(result, BaseException):
+            failed = True
+            exc = ''.join(traceback.format_exception(type(result), result, result.__traceback__))
+            click.echo(f'无法加载 {ext}.\n{exc}', err=True)
+
+    if failed:
+        return
 
     for table in Table.all_tables():
         try:
-            created = run(table.create(verbose=not quiet, run_migrations=False))
+            created = await table.create(verbose=not quiet, run_migrations=False)
         except Exception:
             click.echo(f'无法创建 {table.__tablename__}.\n{traceback.format_exc()}', err=True)
         else:
@@ -179,7 +288,40 @@ def migrate(ctx, cog, quiet):
     click.echo(f'完成迁移 {cog}。')
 
 
-async def apply_migration(cog, quiet, index, *, downgrade=False):
+def group_tables(tables):
+    """Splits tables into groups that don't reference each other through foreign keys."""
+    parent = {table.__tablename__: table.__tablename__ for table in tables}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = name = parent[parent[name]]
+        return name
+
+    for table in tables:
+        for column in table.columns:
+            column_type = column.column_type
+            if isinstance(column_type, ForeignKey) and column_type.table in parent:
+                parent[find(column_type.table)] = find(table.__tablename__)
+
+    groups = {}
+    for table in tables:
+        groups.setdefault(find(table.__tablename__), []).append(table)
+    return list(groups.values())
+
+
+async def migrate_group(pool, tables, quiet, index, *, downgrade=False):
+    # tables that reference each other still succeed or fail together
+    async with pool.acquire() as con:
+        async with con.transaction():
+            for table in tables:
+                try:
+                    await table.migrate(index=index, downgrade=downgrade, verbose=not quiet, connection=con)
+                except RuntimeError as e:
+                    click.echo(f'无法迁移 {table.__tablename__}：{e}', err=True)
+                    raise
+
+
+async def apply_migration(cog, quiet, index, *, downgrade=False, parallel=False):
     try:
         pool = await Table.create_pool(config.postgresql)
     except Exception:
@@ -195,6 +337,19 @@ async def apply_migration(cog, quiet, index, *, downgrade=False):
         click.echo(f'无法加载 {cog}。\n{traceback.format_exc()}', err=True)
         return
 
+    if parallel:
+        # unrelated groups of tables get their own connection and transaction
+        # and run at the same time, a failure only rolls back its own group
+        results = await asyncio.gather(
+            *(migrate_group(pool, group, quiet, index, downgrade=downgrade)
+              for group in group_tables(Table.all_tables())),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, RuntimeError):
+                raise result
+        return
+
     async with pool.acquire() as con:
         tr = con.transaction()
         await tr.start()
@@ -213,23 +368,29 @@ async def apply_migration(cog, quiet, index, *, downgrade=False):
 @click.argument('cog', nargs=1, metavar='[cog]')
 @click.option('-q', '--quiet', help='不那么冗长的输出', is_flag=True)
 @click.option('--index', help='要使用的索引', default=-1)
-def upgrade(cog, quiet, index):
+@click.option('--parallel', help='并发迁移互不相关的表（失败时只回滚相关的表）', is_flag=True)
+def upgrade(cog, quiet, index, parallel):
     """Runs an upgrade from a migration"""
-    run = asyncio.get_event_loop().run_until_complete
-    run(apply_migration(cog, quiet, index))
+    run_cli(apply_migration(cog, quiet, index, parallel=parallel))
 
 
 @db.command(short_help='迁移降级')
 @click.argument('cog', nargs=1, metavar='[cog]')
 @click.option('-q', '--quiet', help='不那么冗长的输出', is_flag=True)
 @click.option('--index', help='要使用的索引', default=-1)
-def downgrade(cog, quiet, index):
+@click.option('--parallel', help='并发迁移互不相关的表（失败时只回滚相关的表）', is_flag=True)
+def downgrade(cog, quiet, index, parallel):
     """Runs an downgrade from a migration"""
-    run = asyncio.get_event_loop().run_until_complete
-    run(apply_migration(cog, quiet, index, downgrade=True))
+    run_cli(apply_migration(cog, quiet, index, downgrade=True, parallel=parallel))
+
 
+async def remove_databases(cog, quiet):
+    try:
+        pool = await Table.create_pool(config.postgresql)
+    except Exception:
+        click.echo(f'无法创建 PostgreSQL 连接池。\n{traceback.format_exc()}', err=True)
+        return
 
-async def remove_databases(pool, cog, quiet):
     async with pool.acquire() as con:
         tr = con.transaction()
         await tr.start()
@@ -260,15 +421,8 @@ def drop(cog, quiet):
     the cog name.
     """
 
-    run = asyncio.get_event_loop().run_until_complete
     click.confirm('你真的想这样做吗？', abort=True)
 
-    try:
-        pool = run(Table.create_pool(config.postgresql))
-    except Exception:
-        click.echo(f'无法创建 PostgreSQL 连接池。\n{traceback.format_exc()}', err=True)
-        return
-
     if not cog.startswith('cogs.'):
         cog = f'cogs.{cog}'
 
@@ -278,7 +432,7 @@ def drop(cog, quiet):
         click.echo(f'无法加载 {cog}。\n{traceback.format_exc()}', err=True)
         return
 
-    run(remove_databases(pool, cog, quiet))
+    run_cli(remove_databases(cog, quiet))
 
 
 if __name__ == '__main__':